@@ -4,11 +4,12 @@
 楽天の購入履歴情報を収集して，Excel ファイルとして出力します．
 
 Usage:
-  rakhist.py [-c CONFIG] [-e] [-N]
+  rakhist.py [-c CONFIG] [-e] [-i] [-N]
 
 Options:
   -c CONFIG    : CONFIG を設定ファイルとして読み込んで実行します．[default: config.yaml]
   -e           : データ収集は行わず，Excel ファイルの出力のみ行います．
+  -i           : 前回以降に増えた注文のみを収集します．
   -N            : サムネイル画像を含めないようにします．
 """
 
@@ -24,23 +25,24 @@ NAME = "rakhist"
 VERSION = "0.1.0"
 
 
-def execute_fetch(handle):
+def execute_fetch(handle, is_incremental=False):
     try:
-        store_rakuten.crawler.fetch_order_item_list(handle)
+        store_rakuten.crawler.fetch_order_item_list(handle, is_incremental)
     except:
-        driver, wait = store_rakuten.handle.get_selenium_driver(handle)
-        local_lib.selenium_util.dump_page(
-            driver, int(random.random() * 100), store_rakuten.handle.get_debug_dir_path(handle)
-        )
+        if store_rakuten.handle.has_selenium_driver(handle):
+            driver, wait = store_rakuten.handle.get_selenium_driver(handle)
+            local_lib.selenium_util.dump_page(
+                driver, int(random.random() * 100), store_rakuten.handle.get_debug_dir_path(handle)
+            )
         raise
 
 
-def execute(config, is_export_mode=False, is_need_thumb=True):
+def execute(config, is_export_mode=False, is_incremental=False, is_need_thumb=True):
     handle = store_rakuten.handle.create(config)
 
     try:
         if not is_export_mode:
-            execute_fetch(handle)
+            execute_fetch(handle, is_incremental)
         store_rakuten.order_history.generate_table_excel(
             handle, store_rakuten.handle.get_excel_file_path(handle), is_need_thumb
         )
@@ -67,8 +69,9 @@ if __name__ == "__main__":
 
     config_file = args["-c"]
     is_export_mode = args["-e"]
+    is_incremental = args["-i"]
     is_need_thumb = not args["-N"]
 
     config = local_lib.config.load(args["-c"])
 
-    execute(config, is_export_mode, is_need_thumb)
+    execute(config, is_export_mode, is_incremental, is_need_thumb)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Web ブラウザを常駐させ，他のプロセスから接続して使えるようにします．
+実行の度に Chrome を起動してログインし直す手間を省きます．
+
+Usage:
+  browser_daemon.py [-d DATA_PATH] [-p PROFILE] [-P DEBUG_PORT] [-C CONTROL_PORT] [-k]
+
+Options:
+  -d DATA_PATH      : Web ブラウザの作業フォルダを指定します．(接続する側の設定と合わせます) [default: data]
+  -p PROFILE        : Web ブラウザのプロファイル名を指定します．[default: Rakhist]
+  -P DEBUG_PORT     : リモートデバッグ用のポートを指定します．[default: 9222]
+  -C CONTROL_PORT   : 制御用のポートを指定します．[default: 9223]
+  -k                : 常駐している Web ブラウザを終了させます．
+"""
+
+import logging
+import multiprocessing.connection
+import os
+import secrets
+
+import local_lib.selenium_util
+
+DEBUG_PORT = 9222
+CONTROL_PORT = 9223
+
+# NOTE: 制御用の接続では受け取ったデータを unpickle するので，他のユーザーが接続できないようにする．
+# 認証用の鍵は起動の度に作り，本人のみ読める作業フォルダ内のファイルで接続する側に渡す
+AUTH_KEY_FILE_NAME = "browser_daemon_{port}.key"
+AUTH_KEY_SIZE = 32
+
+
+def gen_debugger_address(debug_port):
+    return "127.0.0.1:{port}".format(port=debug_port)
+
+
+def get_auth_key_path(data_path, control_port):
+    return data_path / AUTH_KEY_FILE_NAME.format(port=control_port)
+
+
+def create_auth_key(data_path, control_port):
+    auth_key = secrets.token_bytes(AUTH_KEY_SIZE)
+
+    key_path = get_auth_key_path(data_path, control_port)
+    key_path.parent.mkdir(parents=True, exist_ok=True)
+    key_path.unlink(missing_ok=True)
+
+    # NOTE: 書き込む前に他のユーザーから読まれないよう，作成時に権限を指定する
+    fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(auth_key)
+
+    return auth_key
+
+
+def load_auth_key(data_path, control_port):
+    with open(get_auth_key_path(data_path, control_port), "rb") as f:
+        return f.read()
+
+
+def is_driver_alive(driver):
+    try:
+        driver.current_url
+        return True
+    except:
+        return False
+
+
+def serve(profile_name, data_path, debug_port=DEBUG_PORT, control_port=CONTROL_PORT):
+    driver = local_lib.selenium_util.create_driver(profile_name, data_path, debug_port=debug_port)
+
+    listener = multiprocessing.connection.Listener(
+        ("127.0.0.1", control_port), authkey=create_auth_key(data_path, control_port)
+    )
+
+    logging.info(
+        "Browser is ready: {address} (control port: {port})".format(
+            address=gen_debugger_address(debug_port), port=control_port
+        )
+    )
+
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except multiprocessing.AuthenticationError:
+                logging.warning("Reject unauthorized connection")
+                continue
+
+            with conn:
+                command = conn.recv()
+
+                if command == "status":
+                    if not is_driver_alive(driver):
+                        # NOTE: Chrome が落ちていた場合は起動し直す
+                        logging.warning("Browser is not responding, restart")
+                        try:
+                            driver.quit()
+                        except:
+                            pass
+                        driver = local_lib.selenium_util.create_driver(
+                            profile_name, data_path, debug_port=debug_port
+                        )
+
+                    conn.send({"debugger_address": gen_debugger_address(debug_port), "pid": os.getpid()})
+                elif command == "stop":
+                    conn.send({"pid": os.getpid()})
+                    break
+                else:
+                    conn.send({"error": "Unknown command: {command}".format(command=command)})
+    finally:
+        listener.close()
+        get_auth_key_path(data_path, control_port).unlink(missing_ok=True)
+        driver.quit()
+
+    logging.info("Browser is stopped")
+
+
+def request(command, data_path, control_port=CONTROL_PORT):
+    with multiprocessing.connection.Client(
+        ("127.0.0.1", control_port), authkey=load_auth_key(data_path, control_port)
+    ) as conn:
+        conn.send(command)
+        return conn.recv()
+
+
+def get_debugger_address(data_path, control_port=CONTROL_PORT):
+    try:
+        return request("status", data_path, control_port)["debugger_address"]
+    except (OSError, EOFError, multiprocessing.AuthenticationError):
+        # NOTE: 常駐していない場合 (鍵のファイルが無い・古い鍵のファイルが残っている場合を含む)
+        return None
+
+
+def stop(data_path, control_port=CONTROL_PORT):
+    try:
+        request("stop", data_path, control_port)
+        return True
+    except (OSError, EOFError, multiprocessing.AuthenticationError):
+        return False
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+    import pathlib
+
+    import local_lib.logger
+
+    args = docopt(__doc__)
+
+    local_lib.logger.init("browser", level=logging.INFO)
+
+    control_port = int(args["-C"])
+
+    if args["-k"]:
+        if stop(pathlib.Path(args["-d"]), control_port):
+            logging.info("Stop request is sent")
+        else:
+            logging.warning("Browser is not running")
+    else:
+        serve(args["-p"], pathlib.Path(args["-d"]), int(args["-P"]), control_port)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import requests
+import requests.adapters
+
+import local_lib.selenium_util
+
+TIMEOUT_SEC = 30
+
+
+def create_session(agent_name=local_lib.selenium_util.AGENT_NAME, pool_size=10):
+    session = requests.Session()
+
+    # NOTE: keep-alive で接続を使い回せるよう，コネクションプールを並列数に合わせておく
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    session.headers.update(
+        {
+            "User-Agent": agent_name,
+            "Accept-Language": "ja,en-US;q=0.9,en;q=0.8",
+        }
+    )
+
+    return session
+
+
+def set_cookie_list(session, cookie_list):
+    # NOTE: cookie_list は local_lib.selenium_util.get_cookie_list の形式 (CDP の Cookie)
+    for cookie in cookie_list:
+        session.cookies.set(
+            cookie["name"],
+            cookie["value"],
+            domain=cookie["domain"],
+            path=cookie.get("path", "/"),
+            secure=cookie.get("secure", False),
+            expires=None if cookie.get("session", False) else int(cookie["expires"]),
+            rest={"HttpOnly": None} if cookie.get("httpOnly", False) else {},
+        )
+
+
+def get(session, url, allow_status_list=[]):
+    res = session.get(url, timeout=TIMEOUT_SEC)
+
+    # NOTE: allow_status_list に含まれるステータスは，呼び出し側で扱うのでエラーにしない
+    if res.status_code in allow_status_list:
+        return res
+
+    res.raise_for_status()
+
+    # NOTE: Content-Type に charset が無い場合，requests は ISO-8859-1 とみなすので中身から推定させる．
+    # 推定は中身全体を調べるので重く，画像等の text として扱わないものでは行わない
+    content_type = res.headers.get("Content-Type", "")
+    if content_type.startswith("text/") and ("charset" not in content_type):
+        res.encoding = res.apparent_encoding
+
+    return res
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# NOTE: 追記のみ行うジャーナル．各レコードは pickle したデータの前に長さと CRC32 を付けて書き込む．
+# 書き込みの途中で落ちた場合も，読み込み時に末尾の壊れたレコードを捨て，その位置から追記を続ける．
+# fsync は一定の件数・時間毎にまとめて行い，呼び出し側が区切りで sync() を呼ぶ．
+
+import logging
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+RECORD_HEADER = struct.Struct("<II")
+
+SYNC_COUNT = 100
+SYNC_INTERVAL_SEC = 1
+
+
+def pack(record):
+    data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data
+
+
+def load(file_path):
+    record_list = []
+    valid_size = 0
+
+    if not file_path.exists():
+        return (record_list, valid_size)
+
+    with open(file_path, "rb") as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+
+            size, crc = RECORD_HEADER.unpack(header)
+            data = f.read(size)
+            if (len(data) < size) or (zlib.crc32(data) != crc):
+                break
+
+            try:
+                record_list.append(pickle.loads(data))
+            except Exception:
+                break
+
+            valid_size = f.tell()
+
+    if valid_size != file_path.stat().st_size:
+        logging.warning(
+            "Discard broken journal tail: {path} ({size:,} bytes)".format(
+                path=file_path, size=file_path.stat().st_size - valid_size
+            )
+        )
+
+    return (record_list, valid_size)
+
+
+def start(file_path, valid_size=0, header=None, sync_count=SYNC_COUNT, sync_interval_sec=SYNC_INTERVAL_SEC):
+    f = open(file_path, "r+b" if file_path.exists() else "wb")
+    f.truncate(valid_size)
+    f.seek(valid_size)
+
+    journal = {
+        "lock": threading.Lock(),
+        "file": f,
+        "sync_count": sync_count,
+        "sync_interval_sec": sync_interval_sec,
+        "pending": 0,
+        "sync_time": time.perf_counter(),
+    }
+
+    if (valid_size == 0) and (header is not None):
+        append(journal, header)
+        sync(journal)
+
+    return journal
+
+
+def sync_impl(journal):
+    journal["file"].flush()
+    os.fsync(journal["file"].fileno())
+
+    journal["pending"] = 0
+    journal["sync_time"] = time.perf_counter()
+
+
+def append(journal, record):
+    data = pack(record)
+
+    with journal["lock"]:
+        journal["file"].write(data)
+        journal["pending"] += 1
+
+        if (journal["pending"] >= journal["sync_count"]) or (
+            time.perf_counter() - journal["sync_time"] > journal["sync_interval_sec"]
+        ):
+            sync_impl(journal)
+
+
+def sync(journal):
+    with journal["lock"]:
+        if journal["pending"] != 0:
+            sync_impl(journal)
+
+
+def reset(journal, header=None):
+    with journal["lock"]:
+        journal["file"].seek(0)
+        journal["file"].truncate(0)
+
+        if header is not None:
+            journal["file"].write(pack(header))
+
+        sync_impl(journal)
+
+
+def get_size(journal):
+    with journal["lock"]:
+        return journal["file"].tell()
+
+
+def close(journal):
+    sync(journal)
+    journal["file"].close()
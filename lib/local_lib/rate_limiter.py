@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# NOTE: 複数のスレッドからのリクエストを，トークンバケットで流量を，AIMD で同時実行数を
+# 制御する．応答が速く失敗が無い間は徐々に緩め，タイムアウトやエラーが起きたら半分に絞る．
+
+import threading
+import time
+
+RATE = 2.0
+RATE_MIN = 0.2
+RATE_MAX = 10.0
+RATE_STEP = 0.2
+
+CONCURRENCY = 1
+CONCURRENCY_MIN = 1
+CONCURRENCY_MAX = 8
+
+BURST = 2
+BACKOFF_SEC = 10
+LATENCY_EWMA_ALPHA = 0.2
+LATENCY_SLOW_RATIO = 2
+
+
+def create(config={}):
+    return {
+        "lock": threading.Condition(),
+        "rate": config.get("rate", RATE),
+        "rate_min": config.get("rate_min", RATE_MIN),
+        "rate_max": config.get("rate_max", RATE_MAX),
+        "concurrency": config.get("concurrency", CONCURRENCY),
+        "concurrency_min": config.get("concurrency_min", CONCURRENCY_MIN),
+        "concurrency_max": config.get("concurrency_max", CONCURRENCY_MAX),
+        "burst": config.get("burst", BURST),
+        "backoff_sec": config.get("backoff_sec", BACKOFF_SEC),
+        "token": config.get("burst", BURST),
+        "token_time": time.perf_counter(),
+        "resume_time": 0.0,
+        "active": 0,
+        "latency": None,
+        "success_streak": 0,
+        "success": 0,
+        "failure": 0,
+    }
+
+
+def refill(limiter, now):
+    limiter["token"] = min(
+        limiter["token"] + (now - limiter["token_time"]) * limiter["rate"], limiter["burst"]
+    )
+    limiter["token_time"] = now
+
+
+def acquire(limiter):
+    with limiter["lock"]:
+        while True:
+            now = time.perf_counter()
+            refill(limiter, now)
+
+            if now < limiter["resume_time"]:
+                wait_sec = limiter["resume_time"] - now
+            elif limiter["active"] >= limiter["concurrency"]:
+                wait_sec = None
+            elif limiter["token"] < 1:
+                wait_sec = (1 - limiter["token"]) / limiter["rate"]
+            else:
+                limiter["token"] -= 1
+                limiter["active"] += 1
+                return now
+
+            limiter["lock"].wait(wait_sec)
+
+
+def increase(limiter, latency):
+    limiter["success"] += 1
+
+    # NOTE: 応答が普段より大幅に遅い場合は，混雑の兆候とみなして緩めない
+    if (limiter["latency"] is not None) and (latency > limiter["latency"] * LATENCY_SLOW_RATIO):
+        limiter["success_streak"] = 0
+    else:
+        limiter["success_streak"] += 1
+
+        # NOTE: 同時実行数分のリクエストが続けて成功する毎に，1 段階緩める
+        if limiter["success_streak"] >= limiter["concurrency"]:
+            limiter["success_streak"] = 0
+            limiter["concurrency"] = min(limiter["concurrency"] + 1, limiter["concurrency_max"])
+            limiter["rate"] = min(limiter["rate"] + RATE_STEP, limiter["rate_max"])
+
+    if limiter["latency"] is None:
+        limiter["latency"] = latency
+    else:
+        limiter["latency"] = (LATENCY_EWMA_ALPHA * latency) + ((1 - LATENCY_EWMA_ALPHA) * limiter["latency"])
+
+
+def decrease(limiter):
+    limiter["failure"] += 1
+    limiter["success_streak"] = 0
+
+    limiter["concurrency"] = max(limiter["concurrency"] // 2, limiter["concurrency_min"])
+    limiter["rate"] = max(limiter["rate"] / 2, limiter["rate_min"])
+    limiter["token"] = 0
+    limiter["resume_time"] = time.perf_counter() + limiter["backoff_sec"]
+
+
+def release(limiter, start, is_success):
+    with limiter["lock"]:
+        limiter["active"] -= 1
+
+        if is_success:
+            increase(limiter, time.perf_counter() - start)
+        else:
+            decrease(limiter)
+
+        limiter["lock"].notify_all()
+
+
+def penalize(limiter):
+    # NOTE: リクエスト自体は成功したものの，ログインを求められた等，後から問題が分かった場合
+    with limiter["lock"]:
+        decrease(limiter)
+        limiter["lock"].notify_all()
+
+
+def get_metric(limiter):
+    with limiter["lock"]:
+        return {
+            "rate": limiter["rate"],
+            "concurrency": limiter["concurrency"],
+            "active": limiter["active"],
+            "latency": limiter["latency"],
+            "success": limiter["success"],
+            "failure": limiter["failure"],
+        }
+
+
+class request:
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+    def __enter__(self):
+        self.start = acquire(self.limiter)
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        release(self.limiter, self.start, exception_type is None)
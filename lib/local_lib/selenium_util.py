@@ -6,7 +6,7 @@ import inspect
 import logging
 import os
 import random
-import subprocess
+import shutil
 import time
 
 
@@ -19,12 +19,14 @@ from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.wait import WebDriverWait
 
 WAIT_RETRY_COUNT = 1
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
 AGENT_NAME = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
 
 
-def create_driver_impl(profile_name, data_path, agent_name, is_headless):
+def create_driver_impl(profile_name, data_path, agent_name, is_headless, debug_port):
     chrome_data_path = data_path / "chrome"
     log_path = data_path / "log"
 
@@ -33,6 +35,9 @@ def create_driver_impl(profile_name, data_path, agent_name, is_headless):
 
     options = Options()
 
+    # NOTE: DOMContentLoaded の時点で制御を戻し，ページ毎の条件で待つようにする
+    options.page_load_strategy = "eager"
+
     if is_headless:
         options.add_argument("--headless")
 
@@ -50,6 +55,10 @@ def create_driver_impl(profile_name, data_path, agent_name, is_headless):
 
     options.add_argument("user-agent={agent_name}".format(agent_name=agent_name))
 
+    if debug_port is not None:
+        # NOTE: 他のプロセスから attach_driver で接続できるようにする
+        options.add_argument("--remote-debugging-port={port}".format(port=debug_port))
+
     driver = webdriver.Chrome(
         service=Service(
             log_path=str(log_path / "webdriver.log"),
@@ -59,6 +68,14 @@ def create_driver_impl(profile_name, data_path, agent_name, is_headless):
     )
 
     driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
+    set_agent(driver, agent_name)
+
+    driver.set_page_load_timeout(30)
+
+    return driver
+
+
+def set_agent(driver, agent_name):
     driver.execute_cdp_cmd(
         "Network.setUserAgentOverride",
         {
@@ -82,17 +99,174 @@ def create_driver_impl(profile_name, data_path, agent_name, is_headless):
         },
     )
 
+
+def create_driver(profile_name, data_path, agent_name=AGENT_NAME, is_headless=True, debug_port=None):
+    # NOTE: 1回だけ自動リトライ
+    try:
+        return create_driver_impl(profile_name, data_path, agent_name, is_headless, debug_port)
+    except:
+        return create_driver_impl(profile_name, data_path, agent_name, is_headless, debug_port)
+
+
+def attach_driver(debugger_address, data_path, agent_name=AGENT_NAME):
+    log_path = data_path / "log"
+
+    os.makedirs(log_path, exist_ok=True)
+
+    # NOTE: 起動済みの Chrome に接続するので，起動時の引数は指定できない
+    options = Options()
+    options.page_load_strategy = "eager"
+    options.debugger_address = debugger_address
+
+    driver = webdriver.Chrome(
+        service=Service(
+            log_path=str(log_path / "webdriver.log"),
+            service_args=["--verbose"],
+        ),
+        options=options,
+    )
+
+    set_agent(driver, agent_name)
+
     driver.set_page_load_timeout(30)
 
     return driver
 
 
-def create_driver(profile_name, data_path, agent_name=AGENT_NAME, is_headless=True):
-    # NOTE: 1回だけ自動リトライ
-    try:
-        return create_driver_impl(profile_name, data_path, agent_name, is_headless)
-    except:
-        return create_driver_impl(profile_name, data_path, agent_name, is_headless)
+def clone_profile(data_path, src_profile_name, dst_profile_name):
+    chrome_data_path = data_path / "chrome"
+
+    src_path = chrome_data_path / src_profile_name
+    dst_path = chrome_data_path / dst_profile_name
+
+    if not src_path.exists():
+        return
+
+    shutil.rmtree(dst_path, ignore_errors=True)
+
+    # NOTE: 起動中のプロファイルをコピーするので，ロックファイルやキャッシュは除外する
+    shutil.copytree(
+        src_path,
+        dst_path,
+        ignore=shutil.ignore_patterns("Singleton*", "*.lock", "LOCK", "Cache", "Code Cache", "GPUCache"),
+        ignore_dangling_symlinks=True,
+    )
+
+
+COOKIE_PARAM_KEY_LIST = ["name", "value", "domain", "path", "secure", "httpOnly", "sameSite", "expires"]
+
+
+def get_cookie_list(driver):
+    return driver.execute_cdp_cmd("Network.getAllCookies", {})["cookies"]
+
+
+def gen_cookie_param(cookie):
+    param = {key: cookie[key] for key in COOKIE_PARAM_KEY_LIST if key in cookie}
+
+    # NOTE: セッション Cookie は expires が -1 になっているので，そのまま渡すと即座に失効する
+    if cookie.get("session", False):
+        param.pop("expires", None)
+
+    return param
+
+
+def set_cookie_list(driver, cookie_list):
+    # NOTE: Network.setCookies はページを開いていなくても任意のドメインの Cookie を設定できる
+    driver.execute_cdp_cmd("Network.setCookies", {"cookies": list(map(gen_cookie_param, cookie_list))})
+
+
+EXTRACT_SCRIPT = """
+const [fieldMap, rowXpath, rowFieldMap] = arguments;
+
+const findElem = (xpath, context) =>
+    document.evaluate(xpath, context, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+
+const extractField = (fieldMap, context) => {
+    const value = {};
+    for (const [key, [xpath, prop]] of Object.entries(fieldMap)) {
+        const elem = findElem(xpath, context);
+        if (elem === null) {
+            value[key] = null;
+        } else if (prop === "text") {
+            value[key] = elem.innerText.trim();
+        } else {
+            value[key] = elem[prop];
+        }
+    }
+    return value;
+};
+
+const rowList = [];
+if (rowXpath !== null) {
+    const result = document.evaluate(rowXpath, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+    for (let i = 0; i < result.snapshotLength; i++) {
+        rowList.push(extractField(rowFieldMap, result.snapshotItem(i)));
+    }
+}
+
+return { field: extractField(fieldMap, document), row_list: rowList };
+"""
+
+
+def extract(driver, field_map, row_xpath=None, row_field_map={}):
+    # NOTE: field_map は {キー: (XPath, "text" もしくはプロパティ名)} の形式．
+    # 要素毎に find_element を呼ぶと，その都度 WebDriver との通信が発生するので，
+    # ページ内の必要な値を 1 回の execute_script でまとめて取り出す．
+    # row_field_map の XPath は，row_xpath で見つかった各要素からの相対パスで指定する．
+    return driver.execute_script(EXTRACT_SCRIPT, field_map, row_xpath, row_field_map)
+
+
+READY_SCRIPT = """
+const [readyStateList, xpath, idleMsec, probeXpath] = arguments;
+
+// NOTE: 新しいタブを開いた直後は about:blank が complete になっている
+if (location.href === "about:blank") {
+    return false;
+}
+if (!readyStateList.includes(document.readyState)) {
+    return false;
+}
+if (
+    xpath !== null &&
+    document.evaluate(xpath, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue === null
+) {
+    return false;
+}
+if (idleMsec !== null) {
+    const lastResponse = Math.max(0, ...performance.getEntriesByType("resource").map((entry) => entry.responseEnd));
+    if (performance.now() - lastResponse < idleMsec) {
+        return false;
+    }
+}
+return {
+    url: location.href,
+    probe:
+        probeXpath !== null &&
+        document.evaluate(probeXpath, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue !==
+            null,
+};
+"""
+
+READY_STATE_LIST = {
+    "interactive": ["interactive", "complete"],
+    "complete": ["complete"],
+}
+
+
+def wait_for_ready(
+    driver, timeout, ready_state="interactive", xpath=None, idle_msec=None, probe_xpath=None, poll_sec=0.05
+):
+    # NOTE: document.readyState，目印となる要素の有無，直近の通信の有無を 1 回の
+    # execute_script でまとめて判定し，条件が揃った時点ですぐに制御を戻す．
+    # idle_msec を指定した場合は，その間新たなリソースの読み込みが完了していなければ
+    # ネットワークが落ち着いたとみなす．
+    # 表示完了時の URL と，probe_xpath に一致する要素の有無を返すので，呼び出し側は
+    # 追加の通信無しにリダイレクト等を判定できる．
+    return WebDriverWait(driver, timeout, poll_frequency=poll_sec).until(
+        lambda driver: driver.execute_script(
+            READY_SCRIPT, READY_STATE_LIST[ready_state], xpath, idle_msec, probe_xpath
+        )
+    )
 
 
 def xpath_exists(driver, xpath):
@@ -184,6 +358,39 @@ def clear_cache(driver):
     driver.execute_cdp_cmd("Network.clearBrowserCache", {})
 
 
+def gen_ext_pattern_list(ext_list):
+    # NOTE: パターンは URL の末尾まで一致する必要があるので，クエリ文字列 (サムネイルの ?_ex=128x128 等)
+    # が付いた URL 用のパターンも加える
+    return [pattern.format(ext=ext) for ext in ext_list for pattern in ["*.{ext}", "*.{ext}?*"]]
+
+
+BLOCK_URL_PATTERN_MAP = {
+    "image": gen_ext_pattern_list(["jpg", "jpeg", "png", "gif", "webp", "svg", "ico"]),
+    "font": gen_ext_pattern_list(["woff", "woff2", "ttf", "otf", "eot"]),
+    "media": gen_ext_pattern_list(["mp4", "webm", "mp3", "m4a"]),
+    "ad": [
+        "*doubleclick.net*",
+        "*googlesyndication.com*",
+        "*googletagmanager.com*",
+        "*google-analytics.com*",
+        "*googleadservices.com*",
+        "*facebook.net*",
+        "*criteo.com*",
+        "*rat.rakuten.co.jp*",
+    ],
+}
+
+
+def gen_block_url_list(category_list):
+    return [pattern for category in category_list for pattern in BLOCK_URL_PATTERN_MAP[category]]
+
+
+def set_block_url_list(driver, url_list):
+    # NOTE: Network ドメインを有効にしておかないと反映されない
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": url_list})
+
+
 def clean_dump(dump_path, keep_days=1):
     if not dump_path.exists():
         return
@@ -201,11 +408,61 @@ def clean_dump(dump_path, keep_days=1):
             item.unlink(missing_ok=True)
 
 
+def get_child_pid_map():
+    child_pid_map = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{pid}/stat".format(pid=entry), "r") as f:
+                stat = f.read()
+        except OSError:
+            # NOTE: 走査中に終了したプロセス
+            continue
+
+        # NOTE: プロセス名に空白や括弧が含まれる場合があるので，最後の括弧以降を解析する
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        child_pid_map.setdefault(ppid, []).append(int(entry))
+
+    return child_pid_map
+
+
+def get_process_tree_rss(pid):
+    child_pid_map = get_child_pid_map()
+
+    total = 0
+    pid_list = [pid]
+    while len(pid_list) != 0:
+        target_pid = pid_list.pop()
+        pid_list.extend(child_pid_map.get(target_pid, []))
+
+        try:
+            with open("/proc/{pid}/statm".format(pid=target_pid), "r") as f:
+                total += int(f.read().split()[1]) * PAGE_SIZE
+        except OSError:
+            continue
+
+    return total
+
+
+def get_driver_pid(driver):
+    process = getattr(driver.service, "process", None)
+
+    return None if process is None else process.pid
+
+
+def get_tree_memory(driver):
+    # NOTE: /proc が無い環境 (Windows 等) では計測しない
+    pid = get_driver_pid(driver)
+    if (pid is None) or (not os.path.exists("/proc")):
+        return None
+
+    # NOTE: smem の PSS と異なり，共有メモリはプロセス毎に重複して数えられるので多めになる
+    return get_process_tree_rss(pid) // (1024 * 1024)
+
+
 def get_memory_info(driver):
-    total = subprocess.Popen(
-        "smem -t -c pss -P chrome | tail -n 1", shell=True, stdout=subprocess.PIPE
-    ).communicate()[0]
-    total = int(str(total, "utf-8").strip()) // 1024
+    total = get_tree_memory(driver)
 
     js_heap = driver.execute_script("return window.performance.memory.usedJSHeapSize") // (1024 * 1024)
 
@@ -215,8 +472,9 @@ def get_memory_info(driver):
 def log_memory_usage(driver):
     mem_info = get_memory_info(driver)
     logging.info(
-        "Chrome memory: {memory_total:,} MB (JS: {memory_js_heap:,} MB)".format(
-            memory_total=mem_info["total"], memory_js_heap=mem_info["js_heap"]
+        "Chrome memory: {memory_total} MB (JS: {memory_js_heap:,} MB)".format(
+            memory_total="?" if mem_info["total"] is None else "{:,}".format(mem_info["total"]),
+            memory_js_heap=mem_info["js_heap"],
         )
     )
 
@@ -246,12 +504,10 @@ class browser_tab:
     def __enter__(self):
         self.driver.execute_script("window.open('{url}', '_blank');".format(url=self.url))
         self.driver.switch_to.window(self.driver.window_handles[-1])
-        time.sleep(0.1)
 
     def __exit__(self, exception_type, exception_value, traceback):
         self.driver.close()
         self.driver.switch_to.window(self.driver.window_handles[-1])
-        time.sleep(0.1)
 
 
 if __name__ == "__main__":
@@ -7,48 +7,258 @@ Usage:
   serializer.py
 """
 
+# NOTE: 保存するファイルは，ヘッダ (形式のバージョン・圧縮方式・スキーマのバージョン・データ長・CRC32) の
+# 後に，圧縮した pickle を続けた形式．zstandard や lz4 がインストールされていればそれを使い，
+# 無ければ標準の zlib で圧縮する．スキーマのバージョンは，保存するデータの構造を変えた時に呼び出し側で上げる．
+#
+# 保存の度に以前のファイルを世代として残し (file.1, file.2, ...)，読み込み時に壊れていた場合や
+# スキーマのバージョンが異なる場合は，新しい世代から順に使えるものを探して使う．
+
 import logging
+import os
 import pathlib
 import pickle
+import shutil
+import struct
 import tempfile
 import traceback
-import shutil
-import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+MAGIC = b"SRLZ"
+FORMAT_VERSION = 2
+HEADER_PREFIX = struct.Struct("<4sH")
+HEADER = struct.Struct("<4sHHIQI")
+# NOTE: スキーマのバージョンを持たない形式
+HEADER_V1 = struct.Struct("<4sHHQI")
+
+# NOTE: スキーマのバージョンを記録する前に保存したファイルは，このバージョンとみなす
+SCHEMA_VERSION = 1
+
+GENERATION_COUNT = 3
+
+COMPRESS_NONE = 0
+COMPRESS_ZLIB = 1
+COMPRESS_ZSTD = 2
+COMPRESS_LZ4 = 3
+
+
+def get_compress_type():
+    if zstandard is not None:
+        return COMPRESS_ZSTD
+    elif lz4 is not None:
+        return COMPRESS_LZ4
+    else:
+        return COMPRESS_ZLIB
+
+
+def compress(compress_type, data):
+    if compress_type == COMPRESS_ZSTD:
+        return zstandard.ZstdCompressor().compress(data)
+    elif compress_type == COMPRESS_LZ4:
+        return lz4.frame.compress(data)
+    elif compress_type == COMPRESS_ZLIB:
+        # NOTE: 書き込みの速さを優先する
+        return zlib.compress(data, 1)
+    else:
+        return data
+
+
+def decompress(compress_type, data):
+    if compress_type == COMPRESS_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to load this file")
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif compress_type == COMPRESS_LZ4:
+        if lz4 is None:
+            raise RuntimeError("lz4 is required to load this file")
+        return lz4.frame.decompress(data)
+    elif compress_type == COMPRESS_ZLIB:
+        return zlib.decompress(data)
+    elif compress_type == COMPRESS_NONE:
+        return data
+    else:
+        raise RuntimeError("Unknown compress type: {type}".format(type=compress_type))
+
+
+def encode(data, compress_type, schema_version=SCHEMA_VERSION):
+    payload = compress(compress_type, pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+
+    return (
+        HEADER.pack(MAGIC, FORMAT_VERSION, compress_type, schema_version, len(payload), zlib.crc32(payload))
+        + payload
+    )
+
+
+def parse_header(buf):
+    if len(buf) < HEADER_PREFIX.size:
+        raise RuntimeError("Header is truncated")
+
+    magic, version = HEADER_PREFIX.unpack_from(buf)
+
+    if version == 1:
+        header = HEADER_V1
+    elif version == FORMAT_VERSION:
+        header = HEADER
+    else:
+        raise RuntimeError("Unsupported format version: {version}".format(version=version))
+
+    if len(buf) < header.size:
+        raise RuntimeError("Header is truncated")
+
+    if version == 1:
+        magic, version, compress_type, size, crc = header.unpack_from(buf)
+        schema_version = SCHEMA_VERSION
+    else:
+        magic, version, compress_type, schema_version, size, crc = header.unpack_from(buf)
+
+    return (header.size, compress_type, schema_version, size, crc)
+
+
+def verify(buf):
+    # NOTE: pickle の復元はせず，ヘッダとチェックサムのみ確認する
+    header_size, compress_type, schema_version, size, crc = parse_header(buf)
+
+    payload = buf[header_size:]
+    if len(payload) != size:
+        raise RuntimeError("Size mismatch: {actual:,} != {expect:,}".format(actual=len(payload), expect=size))
+    if zlib.crc32(payload) != crc:
+        raise RuntimeError("Checksum mismatch")
+
+    return (compress_type, schema_version, payload)
+
+
+def decode(buf, schema_version=SCHEMA_VERSION):
+    if buf[: len(MAGIC)] != MAGIC:
+        # NOTE: ヘッダを付ける前に保存したファイルは，pickle そのもの
+        return pickle.loads(buf)
+
+    compress_type, stored_schema_version, payload = verify(buf)
+
+    if stored_schema_version != schema_version:
+        raise RuntimeError(
+            "Schema version mismatch: {actual} != {expect}".format(
+                actual=stored_schema_version, expect=schema_version
+            )
+        )
 
+    return pickle.loads(decompress(compress_type, payload))
 
-def store(file_path_str, data):
+
+def is_valid(file_path):
+    try:
+        with open(file_path, "rb") as f:
+            buf = f.read()
+
+        if buf[: len(MAGIC)] == MAGIC:
+            verify(buf)
+        else:
+            # NOTE: ヘッダを付ける前に保存したファイルはチェックサムが無いので，復元できるかで判断する
+            pickle.loads(buf)
+
+        return True
+    except:
+        logging.error(traceback.format_exc())
+        return False
+
+
+def gen_generation_path(file_path, generation):
+    return file_path.with_name("{name}.{generation}".format(name=file_path.name, generation=generation))
+
+
+def get_candidate_path_list(file_path):
+    # NOTE: 新しいものから順に並べる．.old は世代を残す前の形式で保存していた場合のもの
+    return (
+        [file_path]
+        + [gen_generation_path(file_path, generation) for generation in range(1, GENERATION_COUNT + 1)]
+        + [file_path.with_suffix(".old")]
+    )
+
+
+def rotate(file_path):
+    if not file_path.exists():
+        return
+
+    # NOTE: 壊れたファイルを世代として残すと，正常な古い世代が押し出されてしまうので残さない
+    if not is_valid(file_path):
+        logging.warning("{file_path} is broken, do not keep it as a generation".format(file_path=file_path))
+        return
+
+    for generation in range(GENERATION_COUNT, 1, -1):
+        src_path = gen_generation_path(file_path, generation - 1)
+        if src_path.exists():
+            os.replace(src_path, gen_generation_path(file_path, generation))
+
+    # NOTE: 名前を変えずにハードリンクで残し，新しいファイルに置き換えるまでの間もファイルが無い状態にしない．
+    # コピーしないので，データの大きさによらず一定の手間で済む
+    gen_path = gen_generation_path(file_path, 1)
+    try:
+        os.link(file_path, gen_path)
+    except OSError:
+        # NOTE: ハードリンクが使えないファイルシステムの場合
+        shutil.copyfile(file_path, gen_path)
+
+
+def store(file_path_str, data, compress_type=None, schema_version=SCHEMA_VERSION):
     logging.debug("Store {file_path}".format(file_path=file_path_str))
 
     file_path = pathlib.Path(file_path_str)
     try:
+        buf = encode(data, get_compress_type() if compress_type is None else compress_type, schema_version)
+
         f = tempfile.NamedTemporaryFile(dir=str(file_path.parent), delete=False)
-        pickle.dump(data, f)
+        f.write(buf)
+        f.flush()
+        os.fsync(f.fileno())
         f.close()
 
-        if file_path.exists():
-            old_path = file_path.with_suffix(".old")
-            shutil.copy(file_path, old_path)
-
+        rotate(file_path)
         os.replace(f.name, file_path)
+
+        return True
     except:
         logging.error(traceback.format_exc())
+        return False
 
 
-def load(file_path, init_value={}):
+def load(file_path, init_value={}, schema_version=SCHEMA_VERSION):
     logging.debug("Load {file_path}".format(file_path=file_path))
 
-    if not file_path.exists():
-        return init_value
+    file_path = pathlib.Path(file_path)
 
-    try:
-        with open(file_path, "rb") as f:
-            data = init_value.copy()
-            data.update(pickle.load(f))
-            return data
-    except:
-        logging.error(traceback.format_exc())
+    candidate_path_list = [path for path in get_candidate_path_list(file_path) if path.exists()]
+    if len(candidate_path_list) == 0:
         return init_value
 
+    for path in candidate_path_list:
+        try:
+            with open(path, "rb") as f:
+                loaded = decode(f.read(), schema_version)
+        except:
+            logging.error(traceback.format_exc())
+            logging.warning("{path} is not usable, try older generation".format(path=path))
+            continue
+
+        if path != file_path:
+            logging.warning("Load {path} instead of {file_path}".format(path=path, file_path=file_path))
+
+        data = init_value.copy()
+        data.update(loaded)
+        return data
+
+    logging.error("No valid data is found: {file_path}".format(file_path=file_path))
+
+    return init_value
+
 
 if __name__ == "__main__":
     import logger
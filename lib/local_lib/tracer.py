@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# NOTE: 処理の区間 (span) を記録し，Chrome のトレース形式で書き出す．
+# 書き出したファイルは Perfetto (https://ui.perfetto.dev/) や chrome://tracing で開ける．
+# tracer が None の場合は，何もしない共通のオブジェクトを返すだけなので，ほぼ負荷にならない．
+
+import json
+import os
+import threading
+import time
+
+
+def create():
+    return {
+        "lock": threading.Lock(),
+        "pid": os.getpid(),
+        "start": time.perf_counter(),
+        "event_list": [],
+        "thread_name": {},
+    }
+
+
+def record(tracer, name, category, start, end, args):
+    tid = threading.get_ident()
+
+    event = {
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "pid": tracer["pid"],
+        "tid": tid,
+        # NOTE: 単位はマイクロ秒
+        "ts": (start - tracer["start"]) * 1000000,
+        "dur": (end - start) * 1000000,
+    }
+    if args:
+        event["args"] = args
+
+    with tracer["lock"]:
+        tracer["event_list"].append(event)
+        if tid not in tracer["thread_name"]:
+            tracer["thread_name"][tid] = threading.current_thread().name
+
+
+class null_span:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        return False
+
+
+NULL_SPAN = null_span()
+
+
+class complete_span:
+    __slots__ = ["tracer", "name", "category", "args", "start"]
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        if exception_type is not None:
+            self.args["error"] = exception_type.__name__
+
+        record(self.tracer, self.name, self.category, self.start, time.perf_counter(), self.args)
+
+        return False
+
+
+def span(tracer, name, category="default", **args):
+    if tracer is None:
+        return NULL_SPAN
+
+    return complete_span(tracer, name, category, args)
+
+
+def dump(tracer, trace_path):
+    with tracer["lock"]:
+        event_list = [
+            {"name": "thread_name", "ph": "M", "pid": tracer["pid"], "tid": tid, "args": {"name": name}}
+            for tid, name in tracer["thread_name"].items()
+        ] + tracer["event_list"]
+
+    with open(trace_path, "w") as f:
+        json.dump({"traceEvents": event_list, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+
+    return len(event_list)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ローカルのサーバ (store_rakuten.fixture_server) を相手に注文履歴の収集を行い，
+巡回の速度を計測します．実際のサイトにはアクセスしません．
+
+Usage:
+  benchmark.py [-n ORDER] [-y YEAR] [-l LATENCY] [-w WORKER] [-L] [-b] [-i] [-d] [-t TRACE]
+
+Options:
+  -n ORDER      : 生成する注文の数を指定します．[default: 200]
+  -y YEAR       : 注文を生成する年数を指定します．[default: 3]
+  -l LATENCY    : 1 ページあたりの応答の遅延 [秒] を指定します．[default: 0.05]
+  -w WORKER     : 並列に巡回する数を指定します．[default: 2]
+  -L            : ログインを必要にします．(Web ブラウザが必要です)
+  -b            : HTTP ではなく，Web ブラウザで巡回します．
+  -i            : 1 回収集した後，差分収集の速度も計測します．
+  -d            : 注文履歴を SQLite に保存します．
+  -t TRACE      : 処理時間の内訳を，Chrome のトレース形式で TRACE に書き出します．
+"""
+
+import functools
+import logging
+import pathlib
+import tempfile
+import threading
+import time
+
+import store_rakuten.crawler
+import store_rakuten.fixture_server
+import store_rakuten.handle
+import store_rakuten.thumbnail
+
+# NOTE: 計測対象の処理．(モジュール, 関数名) の形式で，呼び出しは全てモジュール経由で行われる
+STAGE_DEF = {
+    "order_list": (store_rakuten.crawler, "fetch_order_list_page"),
+    "order_detail": (store_rakuten.crawler, "fetch_order_item_list_by_order_info"),
+    "item": (store_rakuten.crawler, "fetch_item_detail"),
+    "thumb": (store_rakuten.thumbnail, "save"),
+    "store": (store_rakuten.handle, "store_order_info"),
+}
+
+# NOTE: 巡回中のログは抑え，計測結果のみ表示できるように専用のロガーを使う
+logger = logging.getLogger("benchmark")
+
+
+def gen_config(data_path, worker, is_browser, is_order_db=False, trace_file=None):
+    config = {
+        "base_dir": data_path,
+        "login": {"rakuten": {"user": "user", "pass": "pass"}},
+        "data": {
+            "selenium": "data",
+            "debug": "data/debug",
+            "rakuten": {
+                "cache": {
+                    "order": "data/rakuten/cache.dat",
+                    "item": "data/rakuten/item.dat",
+                    "thumb": "data/rakuten/thumb",
+                }
+            },
+        },
+        "crawl": {
+            "worker": worker,
+            "http": not is_browser,
+            "rate_limit": {"rate": 1000.0, "rate_max": 1000.0, "concurrency": worker},
+        },
+        "output": {"excel": {"font": {"name": "BIZ UDGothic", "size": 12}, "table": "output/rakhist.xlsx"}},
+    }
+
+    if is_order_db:
+        config["data"]["rakuten"]["cache"]["order_db"] = "data/rakuten/order.db"
+
+    if trace_file is not None:
+        # NOTE: 絶対パスにしておけば，作業フォルダを削除した後も残る
+        config["output"]["trace"] = str(pathlib.Path(trace_file).resolve())
+
+    return config
+
+
+def measure_stage(stage_stat, lock, name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with lock:
+                stat = stage_stat.setdefault(name, {"count": 0, "total": 0.0})
+                stat["count"] += 1
+                stat["total"] += time.perf_counter() - start
+
+    return wrapper
+
+
+def install_stage_meter():
+    stage_stat = {}
+    lock = threading.Lock()
+
+    for name, (module, func_name) in STAGE_DEF.items():
+        setattr(module, func_name, measure_stage(stage_stat, lock, name, getattr(module, func_name)))
+
+    return stage_stat
+
+
+def run(config, fixture, stage_stat, is_incremental):
+    stage_stat.clear()
+    page_stat = store_rakuten.fixture_server.get_stat(fixture)
+
+    handle = store_rakuten.handle.create(config)
+
+    start = time.perf_counter()
+    try:
+        store_rakuten.crawler.fetch_order_item_list(handle, is_incremental)
+    finally:
+        elapsed = time.perf_counter() - start
+        order_count = store_rakuten.handle.get_recorded_order_count(handle)
+        store_rakuten.handle.finish(handle)
+
+    page_stat = {
+        key: value - page_stat.get(key, 0)
+        for key, value in store_rakuten.fixture_server.get_stat(fixture).items()
+        if key != "thumb"
+    }
+
+    return {"elapsed": elapsed, "order": order_count, "page": page_stat, "stage": dict(stage_stat)}
+
+
+def report(label, result, expect_order_count):
+    page_count = sum(result["page"].values())
+
+    logger.info(
+        "[{label}] {elapsed:.2f} sec, {page:,} pages ({page_rate:.1f} pages/s), {order:,} orders ({order_rate:.1f} orders/s)".format(
+            label=label,
+            elapsed=result["elapsed"],
+            page=page_count,
+            page_rate=page_count / result["elapsed"],
+            order=result["order"],
+            order_rate=result["order"] / result["elapsed"],
+        )
+    )
+    for page_type, count in sorted(result["page"].items()):
+        logger.info(
+            "[{label}]   page {page_type:12s}: {count:,}".format(
+                label=label, page_type=page_type, count=count
+            )
+        )
+    for name, stat in result["stage"].items():
+        logger.info(
+            "[{label}]   stage {name:12s}: {count:,} times, {total:.2f} sec (avg: {avg:.3f} sec)".format(
+                label=label,
+                name=name,
+                count=stat["count"],
+                total=stat["total"],
+                avg=stat["total"] / stat["count"],
+            )
+        )
+
+    if result["order"] != expect_order_count:
+        logger.error(
+            "[{label}] Collected {order:,} orders, but {expect:,} orders exist".format(
+                label=label, order=result["order"], expect=expect_order_count
+            )
+        )
+        return False
+
+    return True
+
+
+def execute(
+    order_count,
+    year_count,
+    latency,
+    worker,
+    is_login_required,
+    is_browser,
+    is_incremental,
+    is_order_db=False,
+    trace_file=None,
+):
+    fixture = store_rakuten.fixture_server.create(order_count, year_count, latency, is_login_required)
+    server = store_rakuten.fixture_server.start(fixture)
+
+    store_rakuten.fixture_server.apply_const(
+        store_rakuten.fixture_server.gen_base_url(server.server_address[1])
+    )
+    stage_stat = install_stage_meter()
+
+    try:
+        with tempfile.TemporaryDirectory() as data_dir:
+            config = gen_config(pathlib.Path(data_dir), worker, is_browser, is_order_db, trace_file)
+
+            is_success = report("full", run(config, fixture, stage_stat, False), order_count)
+
+            if is_incremental:
+                is_success &= report("incremental", run(config, fixture, stage_stat, True), order_count)
+
+            return is_success
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+    import sys
+
+    import local_lib.logger
+
+    args = docopt(__doc__)
+
+    local_lib.logger.init("benchmark", level=logging.INFO)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    is_success = execute(
+        int(args["-n"]),
+        int(args["-y"]),
+        float(args["-l"]),
+        int(args["-w"]),
+        args["-L"],
+        args["-b"],
+        args["-i"],
+        args["-d"],
+        args["-t"],
+    )
+
+    sys.exit(0 if is_success else 1)
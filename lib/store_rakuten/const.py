@@ -12,5 +12,6 @@ ORDER_URL_BY_NO = (
     "https://order.my.rakuten.co.jp/?page=myorder&act=detail_view&shop_id={store_id}&order_number={no}"
 )
 
+ITEM_URL_PATTERN = r"https?://item.rakuten.co.jp/([^/]+)/([^/]+)"
 
 ORDER_COUNT_PER_PAGE = 25
@@ -4,67 +4,195 @@
 メルカリから販売履歴や購入履歴を収集します．
 
 Usage:
-  crawler.py [-c CONFIG]
+  crawler.py [-c CONFIG] [-i] [-r]
 
 Options:
   -c CONFIG     : CONFIG を設定ファイルとして読み込んで実行します．[default: config.yaml]
+  -i            : 前回以降に増えた注文のみを収集します．
+  -r            : 注文履歴の収集は行わず，有効期限が切れた商品情報のキャッシュを更新します．
 """
 
+import asyncio
+import concurrent.futures
 import logging
 import random
 import math
 import re
 import datetime
+import itertools
+import threading
 import time
 import traceback
+import urllib.parse
 
+from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.wait import WebDriverWait
 
 import store_rakuten.const
 import store_rakuten.handle
+import store_rakuten.parser
+import store_rakuten.pipeline
 
 import local_lib.captcha
 import local_lib.selenium_util
+import local_lib.http_util
+import local_lib.rate_limiter
 
 STATUS_ORDER_COUNT = "[collect] Count of year"
 STATUS_ORDER_ITEM_ALL = "[collect] All orders"
 STATUS_ORDER_ITEM_BY_YEAR = "[collect] Year {year} orders"
+STATUS_ORDER_RETRY = "[collect] Retry orders"
+STATUS_ITEM_DETAIL = "[collect] Item details"
 
 LOGIN_RETRY_COUNT = 2
 FETCH_RETRY_COUNT = 3
+# NOTE: 販売終了した商品のページが返すステータス
+ITEM_GONE_STATUS_LIST = [404, 410]
+
+# NOTE: 複数のスレッドから同時にログインしないようにする．ログインの確認を含めて取る場合があるので，
+# 同じスレッドから重ねて取れるようにする
+LOGIN_LOCK = threading.RLock()
+
+
+# NOTE: ページの種類毎の「表示が完了した」とみなす条件．
+# ログインを求められた場合もすぐに判定できるよう，ログインフォームも目印に含める．
+PAGE_READY_DEF = {
+    "default": {"ready_state": "interactive", "xpath": None, "idle_msec": None},
+    "order_list": {
+        "ready_state": "interactive",
+        "xpath": " | ".join(
+            [
+                store_rakuten.parser.ORDER_LIST_XPATH,
+                store_rakuten.parser.NO_ITEM_XPATH,
+                store_rakuten.parser.YEAR_OPTION_XPATH,
+                store_rakuten.parser.LOGIN_BOX_XPATH,
+            ]
+        ),
+        "idle_msec": None,
+    },
+    "order_detail": {
+        "ready_state": "interactive",
+        "xpath": " | ".join(
+            [
+                store_rakuten.parser.ORDER_DEFAULT_DATE_XPATH,
+                store_rakuten.parser.ORDER_BOOK_DATE_XPATH,
+                store_rakuten.parser.ORDER_ERROR_XPATH,
+                store_rakuten.parser.LOGIN_BOX_XPATH,
+            ]
+        ),
+        "idle_msec": None,
+    },
+    "item": {"ready_state": "complete", "xpath": None, "idle_msec": None},
+    "login": {"ready_state": "interactive", "xpath": None, "idle_msec": 500},
+}
+
+
+# NOTE: ページの種類毎に読み込みを止めるリソース．解析に使わないものは読み込まない．
+# ログインページはキャプチャの画像が必要になるので，画像は止めない．
+BLOCK_CATEGORY_DEF = {
+    "default": [],
+    "order_list": ["image", "font", "media", "ad"],
+    "order_detail": ["image", "font", "media", "ad"],
+    "item": ["image", "font", "media", "ad"],
+    "login": ["font", "media", "ad"],
+}
+
+
+def wait_for_loading(handle, page_type="default"):
+    driver, wait = store_rakuten.handle.get_selenium_driver(handle)
 
+    page_def = PAGE_READY_DEF[page_type]
 
-def wait_for_loading(handle, xpath="//body", sec=1):
-    driver, wait = store_rakuten.handle.get_selenium_driver(handle)
+    start = time.perf_counter()
+    try:
+        return local_lib.selenium_util.wait_for_ready(
+            driver,
+            store_rakuten.handle.get_wait_timeout(handle, page_type),
+            page_def["ready_state"],
+            page_def["xpath"],
+            page_def["idle_msec"],
+            store_rakuten.parser.LOGIN_BOX_XPATH,
+        )
+    except TimeoutException:
+        # NOTE: これまでの傾向から決めたタイムアウトが短すぎた可能性があるので，上限まで待ち直す
+        logging.warning("Timeout while waiting for {page_type} page, retry".format(page_type=page_type))
 
-    wait.until(EC.visibility_of_all_elements_located((By.XPATH, xpath)))
-    time.sleep(sec)
+        return local_lib.selenium_util.wait_for_ready(
+            driver,
+            store_rakuten.handle.WAIT_TIMEOUT_MAX,
+            page_def["ready_state"],
+            page_def["xpath"],
+            page_def["idle_msec"],
+            store_rakuten.parser.LOGIN_BOX_XPATH,
+        )
+    finally:
+        store_rakuten.handle.record_wait_time(handle, page_type, time.perf_counter() - start)
 
 
-def visit_url(handle, url, xpath="//body"):
+def apply_block_category(handle, driver, page_type):
+    return store_rakuten.handle.set_block_category_list(
+        handle,
+        driver,
+        store_rakuten.handle.get_block_category_list(handle, page_type, BLOCK_CATEGORY_DEF[page_type]),
+    )
+
+
+def visit_url(handle, url, page_type="default"):
     driver, wait = store_rakuten.handle.get_selenium_driver(handle)
-    driver.get(url)
 
-    wait_for_loading(handle, xpath)
+    apply_block_category(handle, driver, page_type)
 
+    with local_lib.rate_limiter.request(store_rakuten.handle.get_rate_limiter(handle)):
+        with store_rakuten.handle.trace(handle, "navigate", "browser", url=url):
+            start = time.perf_counter()
+            driver.get(url)
+            store_rakuten.handle.record_wait_time(handle, "navigate", time.perf_counter() - start)
 
-def parse_date(date_text):
-    return datetime.datetime.strptime(date_text, "%Y年%m月%d日")
+        with store_rakuten.handle.trace(handle, "wait_for_loading", "browser", page_type=page_type):
+            page_state = wait_for_loading(handle, page_type)
 
+    page_state["request_url"] = url
 
-def parse_datetime(date_text):
-    return datetime.datetime.strptime(date_text, "%Y年%m月%d日 %H:%M")
+    return page_state
 
 
-def gen_hist_url(year, page):
-    return store_rakuten.const.HIST_URL_BY_YEAR.format(year=year, page=page)
+def fetch_page_tree(handle, url, gone_status_list=[]):
+    with store_rakuten.handle.trace(handle, "http_get", "http", url=url):
+        with local_lib.rate_limiter.request(store_rakuten.handle.get_rate_limiter(handle)):
+            res = local_lib.http_util.get(
+                store_rakuten.handle.get_http_session(handle), url, gone_status_list
+            )
+
+    if res.status_code in gone_status_list:
+        logging.info("Page is gone ({status}): {url}".format(status=res.status_code, url=url))
+        return None
 
+    with store_rakuten.handle.trace(handle, "parse_html", "http"):
+        tree = store_rakuten.parser.parse_html(res.text, res.url)
 
-def gen_item_id_from_url(url):
-    m = re.match(r"https?://item.rakuten.co.jp/([^/]+)/([^/]+)", url)
+    if not store_rakuten.parser.is_login_page(tree):
+        return tree
 
-    return "{store_id}/{item_id}".format(store_id=m.group(1), item_id=m.group(2))
+    # NOTE: ログインを求められるのは，アクセスが多すぎると判断された可能性もあるので，絞る
+    local_lib.rate_limiter.penalize(store_rakuten.handle.get_rate_limiter(handle))
+
+    # NOTE: ログインやキャプチャの対応はブラウザで行い，その後の Cookie を引き継ぐ
+    logging.info("Session is not valid, switch to browser: {url}".format(url=url))
+
+    driver, wait = store_rakuten.handle.get_selenium_driver(handle)
+
+    with LOGIN_LOCK:
+        keep_logged_on(handle, visit_url(handle, url))
+
+        store_rakuten.handle.update_http_cookie(handle)
+
+        return store_rakuten.parser.parse_html(driver.page_source, driver.current_url)
+
+
+def gen_hist_url(year, page):
+    return store_rakuten.const.HIST_URL_BY_YEAR.format(year=year, page=page)
 
 
 def gen_order_url_from_no(no):
@@ -78,198 +206,179 @@ def gen_status_label_by_year(year):
     return STATUS_ORDER_ITEM_BY_YEAR.format(year=year)
 
 
-def save_thumbnail(handle, item, thumb_url):
-    driver, wait = store_rakuten.handle.get_selenium_driver(handle)
-
-    with local_lib.selenium_util.browser_tab(driver, thumb_url):
-        png_data = driver.find_element(By.XPATH, "//img").screenshot_as_png
-
-        with open(store_rakuten.handle.get_thumb_path(handle, item), "wb") as f:
-            f.write(png_data)
-
-
 def fetch_item_detail_default(handle, item):
     driver, wait = store_rakuten.handle.get_selenium_driver(handle)
 
-    with local_lib.selenium_util.browser_tab(driver, item["url"]):
-        wait_for_loading(handle)
+    # NOTE: 注文詳細ページは解析済みなので，タブを開かずに同じタブで移動する．
+    # (新しいタブでは，読み込みを止めるリソースの設定が最初の読み込みに間に合わない)
+    visit_url(handle, item["url"], "item")
 
-        breadcrumb_list = driver.find_elements(By.XPATH, '//td[@class="sdtext"]/a')
-        category = list(map(lambda x: x.text, breadcrumb_list))
+    breadcrumb_list = local_lib.selenium_util.extract(
+        driver, {}, store_rakuten.parser.ITEM_DEFAULT_BREADCRUMB_XPATH, {"text": (".", "text")}
+    )["row_list"]
+    category = list(map(lambda x: x["text"], breadcrumb_list))
 
-        if len(category) >= 1:
-            category.pop(0)
+    if len(category) >= 1:
+        category.pop(0)
 
-        item["category"] = category
+    item["category"] = category
 
 
 def fetch_item_detail_book(handle, item):
     driver, wait = store_rakuten.handle.get_selenium_driver(handle)
 
-    with local_lib.selenium_util.browser_tab(driver, item["url"]):
-        wait_for_loading(handle)
+    # NOTE: 注文詳細ページは解析済みなので，タブを開かずに同じタブで移動する．
+    # (新しいタブでは，読み込みを止めるリソースの設定が最初の読み込みに間に合わない)
+    visit_url(handle, item["url"], "item")
 
-        breadcrumb_list = driver.find_elements(By.XPATH, '//dd[@itemprop="breadcrumb"]/a')
-        category = list(map(lambda x: x.text, breadcrumb_list))
+    breadcrumb_list = local_lib.selenium_util.extract(
+        driver, {}, store_rakuten.parser.ITEM_BOOK_BREADCRUMB_XPATH, {"text": (".", "text")}
+    )["row_list"]
+    category = list(map(lambda x: x["text"], breadcrumb_list))
 
-        if len(category) >= 1:
-            category.pop(0)
+    if len(category) >= 1:
+        category.pop(0)
 
-        item["category"] = category
+    item["category"] = category
 
 
-def fetch_item_detail(handle, item):
-    if item["seller"] == "楽天ブックス":
+def fetch_item_detail_impl(handle, item):
+    if store_rakuten.handle.is_http_enabled(handle):
+        tree = fetch_page_tree(handle, item["url"], ITEM_GONE_STATUS_LIST)
+
+        # NOTE: 販売終了した商品のページは 404 等になる．ブラウザで開いた場合と同様，カテゴリ無しとする
+        item["category"] = (
+            [] if tree is None else store_rakuten.parser.parse_item_category(tree, item["seller"])
+        )
+        return
+
+    if item["seller"] == store_rakuten.parser.SELLER_BOOK:
         return fetch_item_detail_book(handle, item)
     else:
         return fetch_item_detail_default(handle, item)
 
 
-def parse_item_book(handle, item_xpath, item_base):
-    driver, wait = store_rakuten.handle.get_selenium_driver(handle)
+def fetch_item_detail(handle, item):
+    category = store_rakuten.handle.get_item_cache(handle, item["id"])
 
-    link = driver.find_element(By.XPATH, item_xpath + '//h2[contains(@class, "item-detail__title")]/a')
-    name = link.text
-    url = link.get_attribute("href")
-
-    item_id = gen_item_id_from_url(url)
-
-    price_text = driver.find_element(
-        By.XPATH,
-        item_xpath
-        + '//div[contains(@class, "item-detail__price")]/span[contains(@class, "item-detail__price-num")]',
-    ).text
-    price = int(re.match(r".*?(\d{1,3}(?:,\d{3})*)", price_text).group(1).replace(",", ""))
-
-    count = int(
-        driver.find_element(
-            By.XPATH,
-            item_xpath
-            + '//div[contains(@class, "item-detail__order")]/span[contains(@class, "item-detail__order-num")]',
-        ).text
-    )
+    if category is not None:
+        logging.debug("Item detail of {id} [cached]".format(id=item["id"]))
+        item["category"] = category
+        return
 
-    item = {
-        "name": name,
-        "price": price,
-        "count": count,
-        "url": url,
-        "id": item_id,
-    } | item_base
+    with store_rakuten.handle.trace(handle, "item", "item", id=item["id"]):
+        fetch_item_detail_impl(handle, item)
 
-    fetch_item_detail(handle, item)
+    store_rakuten.handle.set_item_cache(handle, item)
 
-    thumb_url = driver.find_element(
-        By.XPATH,
-        item_xpath + '//div[contains(@class, "item-image")]//img',
-    ).get_attribute("src")
-    save_thumbnail(handle, item, thumb_url)
 
-    return item
+def refresh_item_detail(handle):
+    item_list = store_rakuten.handle.get_stale_item_cache_list(handle)
 
+    logging.info("Refresh {count:,} item details".format(count=len(item_list)))
 
-def parse_item_default(handle, item_xpath, item_base):
-    driver, wait = store_rakuten.handle.get_selenium_driver(handle)
+    store_rakuten.handle.set_progress_bar(handle, STATUS_ITEM_DETAIL, len(item_list))
 
-    link = driver.find_element(By.XPATH, item_xpath + '//td[contains(@class, "prodName")]/a')
-    name = link.text
-    url = link.get_attribute("href")
+    for item in item_list:
+        store_rakuten.handle.set_status(handle, "商品情報を更新しています... {id}".format(id=item["id"]))
 
-    item_id = gen_item_id_from_url(url)
+        try:
+            fetch_item_detail_impl(handle, item)
+        except Exception:
+            logging.warning(traceback.format_exc())
+            item["category"] = []
 
-    price_text = driver.find_element(By.XPATH, item_xpath + '//td[contains(@class, "widthPrice")]').text
-    price = int(re.match(r".*?(\d{1,3}(?:,\d{3})*)", price_text).group(1).replace(",", ""))
+        # NOTE: 販売が終了した商品等はカテゴリが得られないので，以前のカテゴリを残す．
+        # キャッシュの更新日時も変えず，次回改めて取得し直す．
+        if len(item["category"]) == 0:
+            logging.warning("Failed to refresh item detail of {id}, keep previous one".format(id=item["id"]))
+        else:
+            store_rakuten.handle.set_item_cache(handle, item)
+            # NOTE: 収集済みの同じ商品にも反映しておく
+            store_rakuten.handle.update_item_category(handle, item)
+
+        store_rakuten.handle.get_progress_bar(handle, STATUS_ITEM_DETAIL).update()
 
-    count = int(driver.find_element(By.XPATH, item_xpath + '//td[contains(@class, "widthQuantity")]').text)
+    store_rakuten.handle.get_progress_bar(handle, STATUS_ITEM_DETAIL).update()
+    store_rakuten.handle.store_order_info(handle)
 
-    include_tax = driver.find_element(By.XPATH, item_xpath + '//td[contains(@class, "widthTax")]').text == "込"
 
+# NOTE: XPath は store_rakuten.parser と共通
+ORDER_ERROR_FIELD_MAP = {
+    "error": (store_rakuten.parser.ORDER_ERROR_XPATH, "text"),
+}
+
+ORDER_BOOK_FIELD_MAP = {
+    "date": (store_rakuten.parser.ORDER_BOOK_DATE_XPATH, "text"),
+    "no": (store_rakuten.parser.ORDER_BOOK_NO_XPATH, "text"),
+}
+ORDER_BOOK_ITEM_FIELD_MAP = {
+    "name": (store_rakuten.parser.ORDER_BOOK_ITEM_LINK_XPATH, "text"),
+    "url": (store_rakuten.parser.ORDER_BOOK_ITEM_LINK_XPATH, "href"),
+    "price": (store_rakuten.parser.ORDER_BOOK_ITEM_PRICE_XPATH, "text"),
+    "count": (store_rakuten.parser.ORDER_BOOK_ITEM_COUNT_XPATH, "text"),
+    "thumb_url": (store_rakuten.parser.ORDER_BOOK_ITEM_THUMB_XPATH, "src"),
+}
+
+ORDER_DEFAULT_FIELD_MAP = {
+    "date": (store_rakuten.parser.ORDER_DEFAULT_DATE_XPATH, "text"),
+    "no": (store_rakuten.parser.ORDER_DEFAULT_NO_XPATH, "text"),
+}
+ORDER_DEFAULT_ITEM_FIELD_MAP = {
+    "name": (store_rakuten.parser.ORDER_DEFAULT_ITEM_LINK_XPATH, "text"),
+    "url": (store_rakuten.parser.ORDER_DEFAULT_ITEM_LINK_XPATH, "href"),
+    "price": (store_rakuten.parser.ORDER_DEFAULT_ITEM_PRICE_XPATH, "text"),
+    "count": (store_rakuten.parser.ORDER_DEFAULT_ITEM_COUNT_XPATH, "text"),
+    "tax": (store_rakuten.parser.ORDER_DEFAULT_ITEM_TAX_XPATH, "text"),
+    "thumb_url": (store_rakuten.parser.ORDER_DEFAULT_ITEM_THUMB_XPATH, "src"),
+}
+
+
+def parse_item_book(handle, row, item_base):
     item = {
-        "name": name,
-        "price": price,
-        "count": count,
-        "url": url,
-        "include_tax": include_tax,
-        "id": item_id,
+        "name": row["name"],
+        "price": store_rakuten.parser.parse_price(row["price"]),
+        "count": int(row["count"]),
+        "url": row["url"],
+        "id": store_rakuten.parser.gen_item_id_from_url(row["url"]),
+        "thumb_url": row["thumb_url"],
     } | item_base
 
-    fetch_item_detail(handle, item)
-
-    thumb_url = driver.find_element(
-        By.XPATH,
-        item_xpath + '//td[contains(@class, "prodImg")]//img',
-    ).get_attribute("src")
-    save_thumbnail(handle, item, thumb_url)
-
     return item
 
 
-def parse_order_book(handle, order_info):
-    ITEM_XPATH = '//div[contains(@class, "shipping-list")]//li[contains(@class, "item")]'
-
-    driver, wait = store_rakuten.handle.get_selenium_driver(handle)
+def parse_item_default(handle, row, item_base):
+    item = {
+        "name": row["name"],
+        "price": store_rakuten.parser.parse_price(row["price"]),
+        "count": int(row["count"]),
+        "url": row["url"],
+        "include_tax": row["tax"] == "込",
+        "id": store_rakuten.parser.gen_item_id_from_url(row["url"]),
+        "thumb_url": row["thumb_url"],
+    } | item_base
 
-    datetime_text = driver.find_element(By.XPATH, '//div[contains(@class, "order-info__date")]').text.rsplit(
-        " ", 1
-    )[0]
-    date = parse_datetime(datetime_text)
+    return item
 
-    no = driver.find_element(
-        By.XPATH, '//div[contains(@class, "order-info__detail")]/span[contains(@class, "order-info__number")]'
-    ).text
 
+def parse_order_book(handle, order_info, page):
     item_base = {
-        "date": date,
-        "no": no,
+        "date": store_rakuten.parser.parse_datetime(page["field"]["date"].rsplit(" ", 1)[0]),
+        "no": page["field"]["no"],
         "seller": order_info["seller"],
     }
 
-    is_unempty = False
-    for i in range(len(driver.find_elements(By.XPATH, ITEM_XPATH))):
-        item_xpath = "(" + ITEM_XPATH + ")[{index}]".format(index=i + 1)
-
-        item = parse_item_book(handle, item_xpath, item_base)
-
-        logging.info("{name} {price:,}円".format(name=item["name"], price=item["price"]))
-
-        store_rakuten.handle.record_item(handle, item)
-        is_unempty = True
-
-    return is_unempty
-
-
-def parse_order_default(handle, order_info):
-    ITEM_XPATH = '//div[contains(@class, "oDrSpecPurchaseInfo")]//tr[contains(@valign, "top") and td[contains(@class, "prodInfo")]]'
-
-    driver, wait = store_rakuten.handle.get_selenium_driver(handle)
+    return list(map(lambda row: parse_item_book(handle, row, item_base), page["row_list"]))
 
-    date_text = driver.find_element(
-        By.XPATH, '//div[contains(@class, "oDrSpecOrderInfo")]//td[contains(@class, "orderDate")]'
-    ).text
-    date = parse_date(date_text)
-
-    no = driver.find_element(
-        By.XPATH, '//div[contains(@class, "oDrSpecOrderInfo")]//td[contains(@class, "orderID")]'
-    ).text
 
+def parse_order_default(handle, order_info, page):
     item_base = {
-        "date": date,
-        "no": no,
+        "date": store_rakuten.parser.parse_date(page["field"]["date"]),
+        "no": page["field"]["no"],
         "seller": order_info["seller"],
     }
 
-    is_unempty = False
-    for i in range(len(driver.find_elements(By.XPATH, ITEM_XPATH))):
-        item_xpath = "(" + ITEM_XPATH + ")[{index}]".format(index=i + 1)
-
-        item = parse_item_default(handle, item_xpath, item_base)
-
-        logging.info("{name} {price:,}円".format(name=item["name"], price=item["price"]))
-
-        store_rakuten.handle.record_item(handle, item)
-        is_unempty = True
-
-    return is_unempty
+    return list(map(lambda row: parse_item_default(handle, row, item_base), page["row_list"]))
 
 
 def parse_order(handle, order_info):
@@ -283,132 +392,253 @@ def parse_order(handle, order_info):
         )
     )
 
-    if local_lib.selenium_util.xpath_exists(driver, '//ul[contains(@class, "mypage_cxl_mordal_text_error")]'):
-        logging.warning(
-            "Error occured: {message}".format(
-                message=driver.find_element(
-                    By.XPATH, '//ul[contains(@class, "mypage_cxl_mordal_text_error")]'
-                ).text
+    # NOTE: 注文情報・商品一覧・エラー表示を 1 回の通信でまとめて取り出す
+    with store_rakuten.handle.trace(handle, "extract", "browser"):
+        if order_info["seller"] == store_rakuten.parser.SELLER_BOOK:
+            page = local_lib.selenium_util.extract(
+                driver,
+                ORDER_BOOK_FIELD_MAP | ORDER_ERROR_FIELD_MAP,
+                store_rakuten.parser.ORDER_BOOK_ITEM_XPATH,
+                ORDER_BOOK_ITEM_FIELD_MAP,
+            )
+        else:
+            page = local_lib.selenium_util.extract(
+                driver,
+                ORDER_DEFAULT_FIELD_MAP | ORDER_ERROR_FIELD_MAP,
+                store_rakuten.parser.ORDER_DEFAULT_ITEM_XPATH,
+                ORDER_DEFAULT_ITEM_FIELD_MAP,
             )
-        )
 
-        return False
+    if page["field"]["error"] is not None:
+        logging.warning("Error occured: {message}".format(message=page["field"]["error"]))
+        local_lib.rate_limiter.penalize(store_rakuten.handle.get_rate_limiter(handle))
 
-    if order_info["seller"] == "楽天ブックス":
-        is_unempty = parse_order_book(handle, order_info)
+        return []
+
+    if order_info["seller"] == store_rakuten.parser.SELLER_BOOK:
+        return parse_order_book(handle, order_info, page)
     else:
-        is_unempty = parse_order_default(handle, order_info)
+        return parse_order_default(handle, order_info, page)
 
-    return is_unempty
+
+def parse_order_by_http(handle, order_info):
+    logging.info(
+        "Parse order: {date} - {seller} - {no}".format(
+            date=order_info["date"].strftime("%Y-%m-%d"),
+            seller=order_info["seller"],
+            no=order_info["no"],
+        )
+    )
+
+    tree = fetch_page_tree(handle, order_info["url"])
+
+    error_message = store_rakuten.parser.parse_order_error(tree)
+    if error_message is not None:
+        logging.warning("Error occured: {message}".format(message=error_message))
+        local_lib.rate_limiter.penalize(store_rakuten.handle.get_rate_limiter(handle))
+        return []
+
+    return store_rakuten.parser.parse_order(tree, order_info)
 
 
 def fetch_order_item_list_by_order_info(handle, order_info):
-    visit_url(handle, order_info["url"])
-    keep_logged_on(handle)
+    # NOTE: 商品のカテゴリとサムネイルは，後段 (store_rakuten.pipeline) で取得する．
+    # それまでの間，サムネイルの URL は item["thumb_url"] に保持する．
+    if store_rakuten.handle.is_http_enabled(handle):
+        with store_rakuten.handle.trace(handle, "order", "order", no=order_info["no"]):
+            item_list = parse_order_by_http(handle, order_info)
+    else:
+        store_rakuten.handle.recycle_selenium_driver(handle)
+
+        with store_rakuten.handle.trace(handle, "order", "order", no=order_info["no"]):
+            keep_logged_on(handle, visit_url(handle, order_info["url"], "order_detail"))
 
-    if not parse_order(handle, order_info):
+            item_list = parse_order(handle, order_info)
+
+    if len(item_list) == 0:
         logging.warning("Failed to parse order of {no}".format(no=order_info["no"]))
-        time.sleep(1)
-        return False
 
-    return True
+    return item_list
+
+
+def record_order_item_list(handle, item_list):
+    for item in item_list:
+        logging.info("{name} {price:,}円".format(name=item["name"], price=item["price"]))
+
+        store_rakuten.handle.record_item(handle, item)
 
 
 def skip_order_item_list_by_year_page(handle, year, page):
     logging.info("Skip check order of {year} page {page} [cached]".format(year=year, page=page))
-    incr_order = min(
-        store_rakuten.handle.get_order_count(handle, year)
-        - store_rakuten.handle.get_progress_bar(handle, gen_status_label_by_year(year)).count,
-        store_rakuten.const.ORDER_COUNT_PER_PAGE,
+
+    total_page = math.ceil(
+        store_rakuten.handle.get_order_count(handle, year) / store_rakuten.const.ORDER_COUNT_PER_PAGE
     )
+    order_no_list = store_rakuten.handle.get_page_order_no_list(handle, year, page)
+
+    if order_no_list is None:
+        # NOTE: 注文番号を記録していない以前のデータの場合は，件数から推測する
+        incr_order = min(
+            store_rakuten.handle.get_order_count(handle, year)
+            - store_rakuten.handle.get_progress_bar(handle, gen_status_label_by_year(year)).count,
+            store_rakuten.const.ORDER_COUNT_PER_PAGE,
+        )
+    else:
+        incr_order = len(order_no_list)
+
     store_rakuten.handle.get_progress_bar(handle, gen_status_label_by_year(year)).update(incr_order)
     store_rakuten.handle.get_progress_bar(handle, STATUS_ORDER_ITEM_ALL).update(incr_order)
 
-    # NOTE: これ，状況によっては最終ページで成り立たないので，良くない
-    return incr_order != store_rakuten.const.ORDER_COUNT_PER_PAGE
+    return (incr_order < store_rakuten.const.ORDER_COUNT_PER_PAGE) or (page >= total_page)
+
+
+ORDER_LIST_FIELD_MAP = {
+    "date": (store_rakuten.parser.ORDER_LIST_DATE_XPATH, "text"),
+    "no": (store_rakuten.parser.ORDER_LIST_NO_XPATH, "text"),
+    "seller": (store_rakuten.parser.ORDER_LIST_SELLER_XPATH, "text"),
+    "url": (store_rakuten.parser.ORDER_LIST_URL_XPATH, "href"),
+}
 
 
-def fetch_order_item_list_by_year_page(handle, year, page, retry=0):
-    ORDER_DATE_XPATH = '//div[contains(@class, "oDrListItem") and table]'
+ORDER_LIST_PAGE_FIELD_MAP = {
+    "no_item": (store_rakuten.parser.NO_ITEM_XPATH, "text"),
+    "total": (store_rakuten.parser.TOTAL_ITEM_XPATH, "text"),
+}
 
+
+def parse_order_list(handle):
     driver, wait = store_rakuten.handle.get_selenium_driver(handle)
 
+    with store_rakuten.handle.trace(handle, "extract", "browser"):
+        page = local_lib.selenium_util.extract(
+            driver, ORDER_LIST_PAGE_FIELD_MAP, store_rakuten.parser.ORDER_LIST_XPATH, ORDER_LIST_FIELD_MAP
+        )
+
+    order_list = []
+    for row in page["row_list"]:
+        if row["no"] is None:
+            logging.warning("Failed to detect orderID")
+            continue
+
+        order_list.append(
+            {
+                "date": store_rakuten.parser.parse_date(row["date"]),
+                "no": row["no"],
+                "url": row["url"],
+                "seller": row["seller"],
+            }
+        )
+
+    with store_rakuten.handle.trace(handle, "extract", "browser"):
+        year_list = sorted(
+            map(
+                lambda row: int(row["value"]),
+                local_lib.selenium_util.extract(
+                    driver, {}, store_rakuten.parser.YEAR_OPTION_XPATH, {"value": (".", "value")}
+                )["row_list"],
+            )
+        )
+
+    if page["field"]["no_item"] is not None:
+        count = 0
+    else:
+        count = int(page["field"]["total"])
+
+    return {"year_list": year_list, "count": count, "order_list": order_list}
+
+
+def fetch_order_list_page(handle, url):
+    # NOTE: 注文一覧ページからは，年の一覧・注文件数・注文一覧がまとめて得られるので，
+    # 実行中は URL 毎に解析結果を保持し，同じページを何度も読み込まないようにする
+    page = store_rakuten.handle.get_page_cache(handle, url)
+    if page is not None:
+        logging.info("URL: {url} [cached]".format(url=url))
+        return page
+
+    logging.info("URL: {url}".format(url=url))
+
+    store_rakuten.handle.recycle_selenium_driver(handle)
+
+    with store_rakuten.handle.trace(handle, "page", "page", url=url):
+        if store_rakuten.handle.is_http_enabled(handle):
+            tree = fetch_page_tree(handle, url)
+            page = {
+                "year_list": store_rakuten.parser.parse_year_list(tree),
+                "count": store_rakuten.parser.parse_order_count(tree),
+                "order_list": store_rakuten.parser.parse_order_list(tree),
+            }
+        else:
+            keep_logged_on(handle, visit_url(handle, url, "order_list"))
+            page = parse_order_list(handle)
+
+    store_rakuten.handle.set_page_cache(handle, url, page)
+
+    return page
+
+
+def fetch_order_list(handle, url):
+    return fetch_order_list_page(handle, url)["order_list"]
+
+
+def fetch_order_list_by_year_page(handle, year, page):
     total_page = math.ceil(
         store_rakuten.handle.get_order_count(handle, year) / store_rakuten.const.ORDER_COUNT_PER_PAGE
     )
 
     store_rakuten.handle.set_status(
         handle,
-        "注文履歴を解析しています... {year}年 {page}/{total_page} ページ".format(year=year, page=page, total_page=total_page),
+        "注文履歴を解析しています... {year}年 {page}/{total_page} ページ".format(
+            year=year, page=page, total_page=total_page
+        ),
     )
 
-    visit_url(handle, gen_hist_url(year, page))
-    keep_logged_on(handle)
-
     logging.info(
         "Check order of {year} page {page}/{total_page}".format(year=year, page=page, total_page=total_page)
     )
-    logging.info("URL: {url}".format(url=driver.current_url))
 
-    order_list = []
-    for i in range(len(driver.find_elements(By.XPATH, ORDER_DATE_XPATH))):
-        order_xpath = "(" + ORDER_DATE_XPATH + "[{index}])".format(index=i + 1)
+    order_list = fetch_order_list(handle, gen_hist_url(year, page))
 
-        date_text = driver.find_element(By.XPATH, order_xpath + '//li[contains(@class, "purchaseDate")]').text
-        date = parse_date(date_text)
-
-        if not local_lib.selenium_util.xpath_exists(
-            driver, order_xpath + "//li[contains(@class, 'orderID')]/span[contains(@class, 'idNum')]"
+    # NOTE: 差分収集が中断していた場合，最新の注文より古い注文が抜けている可能性がある
+    if (year == datetime.datetime.now().year) and (not store_rakuten.handle.get_incremental_pending(handle)):
+        last_item = store_rakuten.handle.get_last_item(handle, year)
+        if (
+            store_rakuten.handle.get_year_checked(handle, year)
+            and (last_item != None)
+            and (last_item["no"] in map(lambda order_info: order_info["no"], order_list))
         ):
-            logging.warning("Failed to detect orderID")
-            continue
+            # NOTE: 以降のページは開いていないので，巡回済みの印は付けない．
+            # 今年の巡回状況は次回の読み込み時に破棄されるので，再巡回にはならない．
+            logging.info("Latest order found, skipping analysis of subsequent pages")
 
-        no = driver.find_element(
-            By.XPATH,
-            order_xpath + "//li[contains(@class, 'orderID')]/span[contains(@class, 'idNum')]",
-        ).text
+            return (order_list, True)
 
-        seller = driver.find_element(By.XPATH, order_xpath + "//li[contains(@class, 'shopName')]/a").text
+    return (order_list, page >= total_page)
 
-        url = driver.find_element(
-            By.XPATH, order_xpath + "//li[contains(@class, 'oDrDetailList')]/a"
-        ).get_attribute("href")
 
-        order_list.append({"date": date, "no": no, "url": url, "seller": seller})
-
-    time.sleep(1)
+def fetch_new_order_list_by_year_page(handle, year, page):
+    store_rakuten.handle.set_status(
+        handle, "新しい注文を探しています... {year}年 {page} ページ".format(year=year, page=page)
+    )
 
-    for order_info in order_list:
-        if not store_rakuten.handle.get_order_stat(handle, order_info["no"]):
-            fetch_order_item_list_by_order_info(handle, order_info)
-        else:
-            logging.info(
-                "Done order: {date} - {no} [cached]".format(
-                    date=order_info["date"].strftime("%Y-%m-%d"), no=order_info["no"]
-                )
-            )
+    logging.info("Check new order of {year} page {page}".format(year=year, page=page))
 
-        store_rakuten.handle.get_progress_bar(handle, gen_status_label_by_year(year)).update()
-        store_rakuten.handle.get_progress_bar(handle, STATUS_ORDER_ITEM_ALL).update()
+    order_list = fetch_order_list(handle, gen_hist_url(year, page))
 
-        if year == datetime.datetime.now().year:
-            last_item = store_rakuten.handle.get_last_item(handle, year)
-            if (
-                store_rakuten.handle.get_year_checked(handle, year)
-                and (last_item != None)
-                and (last_item["no"] == order_info["no"])
-            ):
-                logging.info("Latest order found, skipping analysis of subsequent pages")
-                for i in range(total_page):
-                    store_rakuten.handle.set_page_checked(handle, year, i + 1)
+    # NOTE: 注文一覧は新しい順に並んでいるので，収集済みの注文より後ろは全て収集済み
+    new_order_list = list(
+        itertools.takewhile(
+            lambda order_info: not store_rakuten.handle.get_order_stat(handle, order_info["no"]), order_list
+        )
+    )
 
-    return page >= total_page
+    return (
+        new_order_list,
+        len(new_order_list) != len(order_list),
+        len(order_list) < store_rakuten.const.ORDER_COUNT_PER_PAGE,
+    )
 
 
 def fetch_order_item_list_by_year(handle, year, start_page=1):
-    visit_url(handle, gen_hist_url(year, start_page))
-    keep_logged_on(handle)
-
     year_list = store_rakuten.handle.get_year_list(handle)
 
     logging.info(
@@ -423,20 +653,8 @@ def fetch_order_item_list_by_year(handle, year, start_page=1):
         store_rakuten.handle.get_order_count(handle, year),
     )
 
-    page = start_page
-    while True:
-        if not store_rakuten.handle.get_page_checked(handle, year, page):
-            is_last = fetch_order_item_list_by_year_page(handle, year, page)
-            store_rakuten.handle.set_page_checked(handle, year, page)
-        else:
-            is_last = skip_order_item_list_by_year_page(handle, year, page)
-
-        store_rakuten.handle.store_order_info(handle)
-
-        if is_last:
-            break
-
-        page += 1
+    with store_rakuten.handle.trace(handle, "year", "year", year=year, start_page=start_page):
+        asyncio.run(store_rakuten.pipeline.crawl_year(handle, year, start_page))
 
     store_rakuten.handle.get_progress_bar(handle, gen_status_label_by_year(year)).update()
 
@@ -444,22 +662,9 @@ def fetch_order_item_list_by_year(handle, year, start_page=1):
 
 
 def fetch_year_list(handle):
-    driver, wait = store_rakuten.handle.get_selenium_driver(handle)
-
-    visit_url(handle, store_rakuten.const.HIST_URL)
-
-    keep_logged_on(handle)
-
-    year_list = list(
-        sorted(
-            map(
-                lambda elem: int(elem.get_attribute("value")),
-                driver.find_elements(
-                    By.XPATH, '//select[@id="selectPeriodYear"]/option[contains(@value, "20")]'
-                ),
-            )
-        )
-    )
+    # NOTE: 年の一覧は注文一覧ページのどれにも含まれるので，今年の 1 ページ目から取得する．
+    # 今年の注文件数や注文一覧を調べる際に，読み込み直さずに済む．
+    year_list = fetch_order_list_page(handle, gen_hist_url(datetime.datetime.now().year, 1))["year_list"]
 
     store_rakuten.handle.set_year_list(handle, year_list)
 
@@ -469,59 +674,91 @@ def fetch_year_list(handle):
 
 
 def fetch_order_count_by_year(handle, year):
-    driver, wait = store_rakuten.handle.get_selenium_driver(handle)
-
     store_rakuten.handle.set_status(handle, "注文件数を調べています... {year}年".format(year=year))
 
-    visit_url(handle, gen_hist_url(year, 1))
+    return fetch_order_list_page(handle, gen_hist_url(year, 1))["count"]
 
-    if local_lib.selenium_util.xpath_exists(driver, '//div[contains(@class, "noItem")]'):
-        return 0
 
-    return int(
-        driver.find_element(
-            By.XPATH, '//div[contains(@class, "oDrPager")]//span[contains(@class, "totalItem")]'
-        ).text
-    )
+def submit_fetch_order_count_by_year(handle, executor, year):
+    if store_rakuten.handle.is_http_enabled(handle):
+        return executor.submit(fetch_order_count_by_year, handle, year)
+    elif store_rakuten.handle.get_worker_count(handle) > 1:
+        return store_rakuten.handle.run_on_selenium_worker(handle, fetch_order_count_by_year, year)
+    else:
+        # NOTE: ブラウザが 1 つしか無い場合は，従来通り順に調べる
+        future = concurrent.futures.Future()
+        future.set_result(fetch_order_count_by_year(handle, year))
+        return future
 
 
-def fetch_order_count(handle):
+def start_fetch_order_count(handle):
     year_list = store_rakuten.handle.get_year_list(handle)
 
     logging.info("Collect order count")
 
     store_rakuten.handle.set_progress_bar(handle, STATUS_ORDER_COUNT, len(year_list))
 
-    total_count = 0
-    for year in year_list:
-        if year >= store_rakuten.handle.get_cache_last_modified(handle).year:
-            count = fetch_order_count_by_year(handle, year)
-            store_rakuten.handle.set_order_count(handle, year, count)
-            logging.info("Year {year}: {count:4,} orders".format(year=year, count=count))
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=store_rakuten.handle.COUNT_WORKER_COUNT)
+
+    # NOTE: 巡回は新しい年から行うので，件数も新しい年から調べる
+    count_future_map = {}
+    for year in reversed(year_list):
+        # NOTE: 件数を調べ終える前に中断した場合，更新日時だけが進んで件数が無い年が残るので，それも調べる
+        if (year >= store_rakuten.handle.get_cache_last_modified(handle).year) or (
+            not store_rakuten.handle.has_order_count(handle, year)
+        ):
+            count_future_map[year] = submit_fetch_order_count_by_year(handle, executor, year)
         else:
-            count = store_rakuten.handle.get_order_count(handle, year)
-            logging.info("Year {year}: {count:4,} orders [cached]".format(year=year, count=count))
+            logging.info(
+                "Year {year}: {count:4,} orders [cached]".format(
+                    year=year, count=store_rakuten.handle.get_order_count(handle, year)
+                )
+            )
+            store_rakuten.handle.get_progress_bar(handle, STATUS_ORDER_COUNT).update()
+
+    # NOTE: 投入済みの処理は継続させたまま，結果は wait_fetch_order_count で受け取る
+    executor.shutdown(wait=False)
+
+    return count_future_map
 
-        total_count += count
-        store_rakuten.handle.get_progress_bar(handle, STATUS_ORDER_COUNT).update()
 
-    logging.info("Total order is {total_count:,}".format(total_count=total_count))
+def wait_fetch_order_count(handle, count_future_map, year):
+    if year not in count_future_map:
+        return
+
+    count = count_future_map.pop(year).result()
+    store_rakuten.handle.set_order_count(handle, year, count)
 
+    logging.info("Year {year}: {count:4,} orders".format(year=year, count=count))
     store_rakuten.handle.get_progress_bar(handle, STATUS_ORDER_COUNT).update()
-    store_rakuten.handle.store_order_info(handle)
 
+    if len(count_future_map) == 0:
+        logging.info(
+            "Total order is {total_count:,}".format(
+                total_count=store_rakuten.handle.get_total_order_count(handle)
+            )
+        )
+        store_rakuten.handle.get_progress_bar(handle, STATUS_ORDER_COUNT).update()
+        store_rakuten.handle.store_order_info(handle)
 
-def fetch_order_item_list_all_year(handle):
-    driver, wait = store_rakuten.handle.get_selenium_driver(handle)
 
+def fetch_order_item_list_all_year(handle):
     year_list = fetch_year_list(handle)
-    fetch_order_count(handle)
+
+    # NOTE: 各年の注文件数は並行して調べ，件数が分かった年から順に巡回を始める
+    count_future_map = start_fetch_order_count(handle)
 
     store_rakuten.handle.set_progress_bar(
         handle, STATUS_ORDER_ITEM_ALL, store_rakuten.handle.get_total_order_count(handle)
     )
 
-    for year in year_list:
+    # NOTE: 最近の注文ほど参照されることが多いので，新しい年から巡回する
+    for year in reversed(year_list):
+        wait_fetch_order_count(handle, count_future_map, year)
+        store_rakuten.handle.get_progress_bar(handle, STATUS_ORDER_ITEM_ALL).total = (
+            store_rakuten.handle.get_total_order_count(handle)
+        )
+
         if (
             (year == datetime.datetime.now().year)
             or (year == store_rakuten.handle.get_cache_last_modified(handle).year)
@@ -541,23 +778,132 @@ def fetch_order_item_list_all_year(handle):
     store_rakuten.handle.get_progress_bar(handle, STATUS_ORDER_ITEM_ALL).update()
 
 
-def fetch_order_item_list(handle):
-    store_rakuten.handle.set_status(handle, "巡回ロボットの準備をします...")
-    driver, wait = store_rakuten.handle.get_selenium_driver(handle)
+def fetch_retry_order_item_list(handle):
+    order_count = len(store_rakuten.handle.get_retry_order_list(handle))
+
+    if order_count == 0:
+        return
+
+    logging.info("Retry {count:,} orders failed last time".format(count=order_count))
+
+    store_rakuten.handle.set_progress_bar(handle, STATUS_ORDER_RETRY, order_count)
+
+    asyncio.run(store_rakuten.pipeline.crawl_retry(handle))
+
+    store_rakuten.handle.get_progress_bar(handle, STATUS_ORDER_RETRY).update()
+
+
+def is_incremental_ready(handle):
+    year_list = store_rakuten.handle.get_year_list(handle)
+
+    if store_rakuten.handle.get_incremental_pending(handle):
+        logging.info("Previous incremental check was interrupted")
+        return False
+
+    if (len(year_list) == 0) or any(
+        map(lambda year: not store_rakuten.handle.get_year_checked(handle, year), year_list)
+    ):
+        logging.info("Some years have not been checked yet")
+        return False
+
+    return True
+
+
+def fetch_order_item_list_new(handle):
+    year_list = store_rakuten.handle.get_year_list(handle)
+
+    # NOTE: 年が変わった直後は，今年が年の一覧に含まれていない
+    now_year = datetime.datetime.now().year
+    if now_year not in year_list:
+        store_rakuten.handle.set_year_list(handle, year_list + [now_year])
+
+    logging.info("Check new orders")
+
+    store_rakuten.handle.set_progress_bar(handle, STATUS_ORDER_ITEM_ALL, None)
+
+    # NOTE: 最新側から記録していくので，中断すると古い側の注文が抜けたまま残る．
+    # 完了するまでは印を付けておき，次回は全ての年を巡回させる．
+    store_rakuten.handle.set_incremental_pending(handle, True)
+
+    with store_rakuten.handle.trace(handle, "incremental", "year"):
+        year_list, order_count = asyncio.run(store_rakuten.pipeline.crawl_incremental(handle))
+
+    for year in year_list:
+        store_rakuten.handle.set_year_checked(handle, year)
+
+    logging.info("Found {count:,} new orders".format(count=order_count))
+
+    store_rakuten.handle.get_progress_bar(handle, STATUS_ORDER_ITEM_ALL).update()
+
+    store_rakuten.handle.set_incremental_pending(handle, False)
+
+
+def fetch_order_item_list(handle, is_incremental=False):
+    # NOTE: HTTP で取得する場合，ブラウザはログインが必要になった時点で起動する
+    if not store_rakuten.handle.is_http_enabled(handle):
+        store_rakuten.handle.set_status(handle, "巡回ロボットの準備をします...")
+        store_rakuten.handle.get_selenium_driver(handle)
 
     store_rakuten.handle.set_status(handle, "注文履歴の収集を開始します...")
 
     try:
-        fetch_order_item_list_all_year(handle)
+        fetch_retry_order_item_list(handle)
+
+        if is_incremental and is_incremental_ready(handle):
+            fetch_order_item_list_new(handle)
+        else:
+            fetch_order_item_list_all_year(handle)
+            store_rakuten.handle.set_incremental_pending(handle, False)
     except:
-        local_lib.selenium_util.dump_page(
-            driver, int(random.random() * 100), store_rakuten.handle.get_debug_dir_path(handle)
-        )
+        if store_rakuten.handle.has_selenium_driver(handle):
+            driver, wait = store_rakuten.handle.get_selenium_driver(handle)
+            local_lib.selenium_util.dump_page(
+                driver, int(random.random() * 100), store_rakuten.handle.get_debug_dir_path(handle)
+            )
         raise
+    finally:
+        log_wait_stat(handle)
 
     store_rakuten.handle.set_status(handle, "注文履歴の収集が完了しました．")
 
 
+def log_wait_stat(handle):
+    wait_stat = store_rakuten.handle.get_wait_stat(handle)
+
+    logging.info(
+        "Elapsed {elapsed:,.1f} sec (wait: {wait:,.1f} sec, work: {work:,.1f} sec)".format(
+            elapsed=wait_stat["elapsed"], wait=wait_stat["wait"], work=wait_stat["work"]
+        )
+    )
+    rate_metric = local_lib.rate_limiter.get_metric(store_rakuten.handle.get_rate_limiter(handle))
+    logging.info(
+        "Request: {success:,} succeeded, {failure:,} failed (rate: {rate:.1f} req/s, concurrency: {concurrency})".format(
+            success=rate_metric["success"],
+            failure=rate_metric["failure"],
+            rate=rate_metric["rate"],
+            concurrency=rate_metric["concurrency"],
+        )
+    )
+
+    memory_stat = store_rakuten.handle.get_memory_stat(handle)
+    if memory_stat["last"] is not None:
+        logging.info(
+            "Chrome memory: {last:,} MB (peak: {peak:,} MB, recycled {count:,} times)".format(
+                last=memory_stat["last"], peak=memory_stat["peak"], count=memory_stat["recycle_count"]
+            )
+        )
+
+    for page_type, page_stat in wait_stat["page"].items():
+        logging.info(
+            "Wait for {page_type}: {count:,} times, {total:,.1f} sec (avg: {avg:.2f} sec)".format(
+                page_type=page_type,
+                count=page_stat["count"],
+                total=page_stat["total"],
+                avg=page_stat["total"] / page_stat["count"],
+            )
+        )
+
+
 def execute_login(handle):
     driver, wait = store_rakuten.handle.get_selenium_driver(handle)
 
@@ -569,18 +915,33 @@ def execute_login(handle):
         store_rakuten.handle.get_login_pass(handle)
     )
 
+    submit_elem = driver.find_element(By.XPATH, '//input[@name="submit"]')
     local_lib.selenium_util.click_xpath(driver, '//input[@name="submit"]')
 
-    wait_for_loading(handle)
+    # NOTE: 送信前のページのまま判定してしまわないよう，ページ遷移を待ってから判定する．
+    # ログインの処理と転送には時間がかかることがあるので，通常の待ち時間ではなく上限まで待つ
+    WebDriverWait(driver, store_rakuten.handle.WAIT_TIMEOUT_MAX).until(EC.staleness_of(submit_elem))
+    wait_for_loading(handle, "login")
+
+
+def is_login_redirect(page_state):
+    # NOTE: ログインを求められた場合は，ログイン用のホストに転送されるか，ログインフォームが表示される
+    return page_state["probe"] or (
+        urllib.parse.urlparse(page_state["url"]).netloc
+        != urllib.parse.urlparse(page_state["request_url"]).netloc
+    )
 
 
-def keep_logged_on(handle):
+def login(handle):
     driver, wait = store_rakuten.handle.get_selenium_driver(handle)
 
-    wait_for_loading(handle)
+    local_lib.rate_limiter.penalize(store_rakuten.handle.get_rate_limiter(handle))
 
-    if not local_lib.selenium_util.xpath_exists(driver, '//table[contains(@class, "loginBox")]'):
-        return
+    # NOTE: ログインフォームは，元のページの種類の設定 (画像を止める等) で読み込まれている．
+    # キャプチャの画像が必要になるので，ログインページの設定に切り替えて読み込み直す
+    if apply_block_category(handle, driver, "login"):
+        driver.refresh()
+        wait_for_loading(handle, "login")
 
     logging.info("Try to login")
 
@@ -588,11 +949,16 @@ def keep_logged_on(handle):
         if i != 0:
             logging.info("Retry to login")
 
-        execute_login(handle)
-
-        wait_for_loading(handle)
+        try:
+            execute_login(handle)
+        except TimeoutException:
+            # NOTE: 失敗した 1 回として扱い，その時点のページで判定する
+            logging.warning("Timeout while waiting for login")
 
-        if not local_lib.selenium_util.xpath_exists(driver, '//table[contains(@class, "loginBox")]'):
+        if not local_lib.selenium_util.xpath_exists(driver, store_rakuten.parser.LOGIN_BOX_XPATH):
+            store_rakuten.handle.update_session_expire(
+                handle, local_lib.selenium_util.get_cookie_list(driver)
+            )
             return
 
         logging.warning("Failed to login")
@@ -607,6 +973,28 @@ def keep_logged_on(handle):
     raise Exception("ログインに失敗しました．")
 
 
+def keep_logged_on(handle, page_state=None):
+    driver, wait = store_rakuten.handle.get_selenium_driver(handle)
+
+    # NOTE: ページの表示完了時に得た情報でログイン状態を判断できる場合は，追加の確認をしない
+    if (
+        (page_state is not None)
+        and (not is_login_redirect(page_state))
+        and (not store_rakuten.handle.is_session_expired(handle))
+    ):
+        return
+
+    wait_for_loading(handle)
+
+    if not local_lib.selenium_util.xpath_exists(driver, store_rakuten.parser.LOGIN_BOX_XPATH):
+        store_rakuten.handle.update_session_expire(handle, local_lib.selenium_util.get_cookie_list(driver))
+        return
+
+    # NOTE: ワーカーの Web ブラウザが一斉にログインすると不審なアクセスとみなされやすいので，1 つずつ行う
+    with LOGIN_LOCK:
+        login(handle)
+
+
 if __name__ == "__main__":
     from docopt import docopt
 
@@ -623,7 +1011,10 @@ if __name__ == "__main__":
     driver, wait = store_rakuten.handle.get_selenium_driver(handle)
 
     try:
-        fetch_order_item_list(handle)
+        if args["-r"]:
+            refresh_item_detail(handle)
+        else:
+            fetch_order_item_list(handle, args["-i"])
     except:
         driver, wait = store_rakuten.handle.get_selenium_driver(handle)
         logging.error(traceback.format_exc())
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+楽天の注文履歴・注文詳細・商品・ログインの各ページを模したページを返す，ローカルのサーバです．
+実際のサイトにアクセスせずに，巡回処理の動作確認や速度の計測を行うのに使います．
+
+Usage:
+  fixture_server.py [-p PORT] [-n ORDER] [-y YEAR] [-l LATENCY] [-L] [-s SEED]
+
+Options:
+  -p PORT       : 待ち受けるポートを指定します．[default: 8080]
+  -n ORDER      : 生成する注文の数を指定します．[default: 200]
+  -y YEAR       : 注文を生成する年数を指定します．[default: 3]
+  -l LATENCY    : 1 ページあたりの応答の遅延 [秒] を指定します．[default: 0.05]
+  -L            : ログインしていない場合，ログインページを返します．
+  -s SEED       : 注文を生成する際の乱数の種を指定します．[default: 0]
+"""
+
+import datetime
+import html
+import http.server
+import logging
+import math
+import random
+import threading
+import time
+import urllib.parse
+
+import store_rakuten.const
+import store_rakuten.parser
+
+SESSION_COOKIE_NAME = "fixture_session"
+
+SELLER_LIST = ["テストストア", "サンプル商店", "楽天ブックス"]
+CATEGORY_LIST = [
+    ["食品", "スイーツ・お菓子"],
+    ["日用品雑貨・文房具・手芸", "文房具・事務用品"],
+    ["パソコン・周辺機器", "PCアクセサリー"],
+    ["本・雑誌・コミック", "小説・エッセイ"],
+]
+
+# NOTE: 1x1 の透明な PNG
+THUMB_DATA = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    + "1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082"
+)
+
+PAGE_HEADER = """<!DOCTYPE html>
+<html lang="ja"><head><meta charset="utf-8"><title>{title}</title>
+<link rel="stylesheet" href="/static/style.css"></head><body>
+"""
+PAGE_FOOTER = """<img src="/static/banner.png"><script src="/static/rat.js"></script></body></html>"""
+
+
+def gen_order_list(order_count, year_count, seed):
+    rand = random.Random(seed)
+    now = datetime.datetime.now()
+    start = datetime.datetime(now.year - year_count + 1, 1, 1)
+    span_sec = int((now - start).total_seconds())
+
+    date_list = sorted(
+        (start + datetime.timedelta(seconds=rand.randrange(span_sec)) for _ in range(order_count)),
+        reverse=True,
+    )
+
+    order_list = []
+    for i, date in enumerate(date_list):
+        seller = rand.choice(SELLER_LIST)
+        store_id = (
+            "book"
+            if seller == store_rakuten.parser.SELLER_BOOK
+            else "store{index}".format(index=SELLER_LIST.index(seller))
+        )
+
+        item_list = []
+        for j in range(rand.randint(1, 3)):
+            item_list.append(
+                {
+                    "id": "item{index:05d}".format(index=rand.randrange(order_count * 2)),
+                    "name": "テスト商品 {index}-{sub}".format(index=i, sub=j),
+                    "price": rand.randrange(100, 20000),
+                    "count": rand.randint(1, 3),
+                    "category": rand.choice(CATEGORY_LIST),
+                }
+            )
+
+        order_list.append(
+            {
+                # NOTE: 実際の注文番号と同様に，先頭はショップの番号 (数字)
+                "no": "{shop_no}-{date}-{index:010d}".format(
+                    shop_no=200000 + SELLER_LIST.index(seller), date=date.strftime("%Y%m%d"), index=i
+                ),
+                "date": date,
+                "seller": seller,
+                "store_id": store_id,
+                "item_list": item_list,
+            }
+        )
+
+    return order_list
+
+
+def create(order_count, year_count, latency=0.05, is_login_required=False, seed=0):
+    order_list = gen_order_list(order_count, year_count, seed)
+
+    year_order_map = {}
+    for order in order_list:
+        year_order_map.setdefault(order["date"].year, []).append(order)
+
+    item_map = {}
+    for order in order_list:
+        for item in order["item_list"]:
+            item_map[(order["store_id"], item["id"])] = item
+
+    return {
+        "order_list": order_list,
+        "order_map": {order["no"]: order for order in order_list},
+        "year_order_map": year_order_map,
+        "year_list": list(
+            range(datetime.datetime.now().year - year_count + 1, datetime.datetime.now().year + 1)
+        ),
+        "item_map": item_map,
+        "latency": latency,
+        "is_login_required": is_login_required,
+        "lock": threading.Lock(),
+        "stat": {},
+    }
+
+
+def gen_base_url(port):
+    return "http://127.0.0.1:{port}".format(port=port)
+
+
+def apply_const(base_url):
+    # NOTE: 巡回先を，このサーバに向ける
+    store_rakuten.const.HIST_URL = base_url + "/order/"
+    store_rakuten.const.HIST_URL_BY_YEAR = (
+        base_url + "/order/?page=myorder&act=list&display_span={year}&display_month=0&page_num={page}"
+    )
+    store_rakuten.const.ORDER_URL_BY_NO = (
+        base_url + "/order/?page=myorder&act=detail_view&shop_id={store_id}&order_number={no}"
+    )
+    store_rakuten.const.ITEM_URL_PATTERN = r"https?://127\.0\.0\.1:\d+/item/([^/]+)/([^/]+)"
+
+
+def count_page(fixture, page_type):
+    with fixture["lock"]:
+        fixture["stat"][page_type] = fixture["stat"].get(page_type, 0) + 1
+
+
+def get_stat(fixture):
+    with fixture["lock"]:
+        return dict(fixture["stat"])
+
+
+def gen_order_url(base_url, order):
+    return "{base_url}/order/?page=myorder&act=detail_view&shop_id={store_id}&order_number={no}".format(
+        base_url=base_url, store_id=order["store_id"], no=order["no"]
+    )
+
+
+def gen_item_url(base_url, store_id, item):
+    return "{base_url}/item/{store_id}/{item_id}/".format(
+        base_url=base_url, store_id=store_id, item_id=item["id"]
+    )
+
+
+def gen_thumb_url(base_url, item):
+    return "{base_url}/thumb/{item_id}.png".format(base_url=base_url, item_id=item["id"])
+
+
+def render_order_list(fixture, base_url, year, page):
+    order_list = fixture["year_order_map"].get(year, [])
+
+    start = (page - 1) * store_rakuten.const.ORDER_COUNT_PER_PAGE
+    page_order_list = order_list[start : start + store_rakuten.const.ORDER_COUNT_PER_PAGE]
+
+    body = ['<select id="selectPeriodYear">']
+    for option_year in reversed(fixture["year_list"]):
+        body.append('<option value="{year}">{year}年</option>'.format(year=option_year))
+    body.append("</select>")
+
+    if len(order_list) == 0:
+        body.append('<div class="noItem">該当する注文はありません</div>')
+    else:
+        body.append(
+            '<div class="oDrPager"><span class="totalItem">{count}</span>件 ({page}/{total_page})</div>'.format(
+                count=len(order_list),
+                page=page,
+                total_page=math.ceil(len(order_list) / store_rakuten.const.ORDER_COUNT_PER_PAGE),
+            )
+        )
+
+    for order in page_order_list:
+        body.append(
+            """<div class="oDrListItem clfx"><ul>
+<li class="purchaseDate">{date}</li>
+<li class="orderID">注文番号 <span class="idNum">{no}</span></li>
+<li class="shopName"><a href="{base_url}/shop/{store_id}/">{seller}</a></li>
+<li class="oDrDetailList"><a href="{url}">注文詳細を見る</a></li>
+</ul><table><tr><td>{item_count} 点</td></tr></table></div>""".format(
+                date=order["date"].strftime("%Y年%m月%d日"),
+                no=order["no"],
+                base_url=base_url,
+                store_id=order["store_id"],
+                seller=html.escape(order["seller"]),
+                url=html.escape(gen_order_url(base_url, order)),
+                item_count=len(order["item_list"]),
+            )
+        )
+
+    return "注文履歴", "\n".join(body)
+
+
+def render_order_book(base_url, order):
+    body = [
+        '<div class="order-info">',
+        '<div class="order-info__date">{date} (注文日)</div>'.format(
+            date=order["date"].strftime("%Y年%m月%d日 %H:%M")
+        ),
+        '<div class="order-info__detail">注文番号 <span class="order-info__number">{no}</span></div>'.format(
+            no=order["no"]
+        ),
+        "</div>",
+        '<div class="shipping-list"><ul>',
+    ]
+    for item in order["item_list"]:
+        body.append(
+            """<li class="item">
+<div class="item-image"><img src="{thumb_url}"></div>
+<h2 class="item-detail__title"><a href="{url}">{name}</a></h2>
+<div class="item-detail__price"><span class="item-detail__price-num">{price:,}円</span></div>
+<div class="item-detail__order"><span class="item-detail__order-num">{count}</span></div>
+</li>""".format(
+                thumb_url=gen_thumb_url(base_url, item),
+                url=gen_item_url(base_url, order["store_id"], item),
+                name=html.escape(item["name"]),
+                price=item["price"],
+                count=item["count"],
+            )
+        )
+    body.append("</ul></div>")
+
+    return "注文詳細", "\n".join(body)
+
+
+def render_order_default(base_url, order):
+    body = [
+        '<div class="oDrSpecOrderInfo"><table><tr>',
+        '<td class="orderDate">{date}</td>'.format(date=order["date"].strftime("%Y年%m月%d日")),
+        '<td class="orderID">{no}</td>'.format(no=order["no"]),
+        "</tr></table></div>",
+        '<div class="oDrSpecPurchaseInfo"><table>',
+    ]
+    for item in order["item_list"]:
+        body.append(
+            """<tr valign="top">
+<td class="prodInfo"></td>
+<td class="prodImg"><img src="{thumb_url}"></td>
+<td class="prodName"><a href="{url}">{name}</a></td>
+<td class="widthPrice">{price:,}円</td>
+<td class="widthQuantity">{count}</td>
+<td class="widthTax">込</td>
+</tr>""".format(
+                thumb_url=gen_thumb_url(base_url, item),
+                url=gen_item_url(base_url, order["store_id"], item),
+                name=html.escape(item["name"]),
+                price=item["price"],
+                count=item["count"],
+            )
+        )
+    body.append("</table></div>")
+
+    return "注文詳細", "\n".join(body)
+
+
+def render_item(store_id, item):
+    if store_id == "book":
+        body = '<dl><dt>ジャンル</dt><dd itemprop="breadcrumb"><a href="/">楽天ブックス</a>{link}</dd></dl>'
+    else:
+        body = '<table><tr><td class="sdtext"><a href="/">楽天市場トップ</a>{link}</td></tr></table>'
+
+    return item["name"], body.format(
+        link="".join(
+            ' &gt; <a href="/">{name}</a>'.format(name=html.escape(name)) for name in item["category"]
+        )
+    )
+
+
+def render_login(path):
+    return (
+        "ログイン",
+        """<form method="post" action="/login?return={path}"><table class="loginBox">
+<tr><td><input type="text" id="loginInner_u" name="u"></td></tr>
+<tr><td><input type="password" id="loginInner_p" name="p"></td></tr>
+<tr><td><input type="submit" name="submit" value="ログイン"></td></tr>
+</table></form>""".format(path=urllib.parse.quote(path, safe="")),
+    )
+
+
+def create_handler(fixture):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+        def send_body(self, body, content_type="text/html; charset=utf-8", status=200, header={}):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in header.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_page(self, page_type, title, body):
+            count_page(fixture, page_type)
+
+            time.sleep(fixture["latency"])
+
+            self.send_body((PAGE_HEADER.format(title=title) + body + PAGE_FOOTER).encode("utf-8"))
+
+        def is_logged_in(self):
+            if not fixture["is_login_required"]:
+                return True
+
+            return "{name}=1".format(name=SESSION_COOKIE_NAME) in self.headers.get("Cookie", "")
+
+        def do_POST(self):
+            url = urllib.parse.urlparse(self.path)
+
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            if url.path != "/login":
+                self.send_body(b"", status=404)
+                return
+
+            count_page(fixture, "login")
+
+            return_path = urllib.parse.parse_qs(url.query).get("return", ["/order/"])[0]
+            self.send_body(
+                b"",
+                status=302,
+                header={
+                    "Location": return_path,
+                    "Set-Cookie": "{name}=1; Path=/; Max-Age=86400".format(name=SESSION_COOKIE_NAME),
+                },
+            )
+
+        def do_GET(self):
+            base_url = "http://{host}".format(host=self.headers.get("Host"))
+            url = urllib.parse.urlparse(self.path)
+            query = {key: value[0] for key, value in urllib.parse.parse_qs(url.query).items()}
+            path_list = [part for part in url.path.split("/") if part != ""]
+
+            if url.path.startswith("/static/"):
+                self.send_body(b"", content_type="text/plain")
+            elif (len(path_list) == 2) and (path_list[0] == "thumb"):
+                count_page(fixture, "thumb")
+                self.send_body(THUMB_DATA, content_type="image/png")
+            elif (len(path_list) == 3) and (path_list[0] == "item"):
+                item = fixture["item_map"].get((path_list[1], path_list[2]))
+                if item is None:
+                    self.send_body(b"", status=404)
+                else:
+                    self.send_page("item", *render_item(path_list[1], item))
+            elif (len(path_list) == 1) and (path_list[0] == "order"):
+                if not self.is_logged_in():
+                    self.send_page("login", *render_login(self.path))
+                elif query.get("act") == "detail_view":
+                    order = fixture["order_map"].get(query.get("order_number"))
+                    if order is None:
+                        self.send_page(
+                            "order_error",
+                            "エラー",
+                            '<ul class="mypage_cxl_mordal_text_error"><li>注文が見つかりません</li></ul>',
+                        )
+                    elif order["seller"] == store_rakuten.parser.SELLER_BOOK:
+                        self.send_page("order_detail", *render_order_book(base_url, order))
+                    else:
+                        self.send_page("order_detail", *render_order_default(base_url, order))
+                else:
+                    self.send_page(
+                        "order_list",
+                        *render_order_list(
+                            fixture,
+                            base_url,
+                            int(query.get("display_span", fixture["year_list"][-1])),
+                            int(query.get("page_num", 1)),
+                        ),
+                    )
+            else:
+                self.send_body(b"", status=404)
+
+    return Handler
+
+
+def start(fixture, port=0):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), create_handler(fixture))
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+
+    import local_lib.logger
+
+    args = docopt(__doc__)
+
+    local_lib.logger.init("fixture", level=logging.INFO)
+
+    fixture = create(int(args["-n"]), int(args["-y"]), float(args["-l"]), args["-L"], int(args["-s"]))
+    server = start(fixture, int(args["-p"]))
+
+    logging.info(
+        "Serving {count:,} orders at {url}".format(
+            count=len(fixture["order_list"]), url=gen_base_url(server.server_address[1])
+        )
+    )
+
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        server.shutdown()
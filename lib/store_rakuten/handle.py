@@ -1,15 +1,56 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import logging
 import pathlib
 import enlighten
 import datetime
-import functools
+import collections
+import queue
+import threading
+import concurrent.futures
 
 from selenium.webdriver.support.wait import WebDriverWait
 import openpyxl.styles
 
+import local_lib.browser_daemon
+import local_lib.rate_limiter
 import local_lib.serializer
+import local_lib.tracer
 import local_lib.selenium_util
+import local_lib.http_util
+import local_lib.journal
+import store_rakuten.item
+import store_rakuten.order_db
+
+WAIT_TIMEOUT_MIN = 3
+WAIT_TIMEOUT_MAX = 30
+WAIT_TIMEOUT_RATIO = 4
+WAIT_EWMA_ALPHA = 0.2
+
+ITEM_CACHE_FILE_PATH = "data/rakuten/item.dat"
+ITEM_CACHE_TTL_DAY = 90
+
+# NOTE: 保存するデータの構造を変えた場合は上げる．異なるバージョンのファイルは読み込まない
+ORDER_INFO_SCHEMA_VERSION = 1
+ITEM_CACHE_SCHEMA_VERSION = 1
+
+SESSION_COOKIE_DOMAIN = "rakuten.co.jp"
+# NOTE: 計測用等の寿命が短い Cookie は，ログイン状態の期限の判断には使わない
+SESSION_COOKIE_MIN_SEC = 300
+
+# NOTE: ジャーナルがこのサイズとスナップショットのサイズの大きい方を超えたら，スナップショットにまとめる
+JOURNAL_COMPACT_SIZE_MIN = 1024 * 1024
+
+THUMB_WORKER_COUNT = 4
+# NOTE: 各年の注文件数を並行して調べるスレッドの数
+COUNT_WORKER_COUNT = 4
+
+MEMORY_LIMIT_MB = 2048
+MEMORY_CHECK_INTERVAL_SEC = 10
+MEMORY_SAMPLE_COUNT = 360
+
+SELENIUM_PROFILE_NAME = "Rakhist"
+SELENIUM_WORKER_PROFILE_NAME = "Rakhist_worker_{index}"
 
 
 def create(config):
@@ -17,12 +58,40 @@ def create(config):
         "progress_manager": enlighten.get_manager(),
         "progress_bar": {},
         "config": config,
+        "selenium_local": threading.local(),
+        "http_lock": threading.Lock(),
+        "order_lock": threading.Lock(),
+        "block_category": {},
+        "session_expire": None,
+        "page_cache": {},
+        "memory_stat": {
+            "lock": threading.Lock(),
+            "stop": threading.Event(),
+            "sample": collections.deque(maxlen=MEMORY_SAMPLE_COUNT),
+            "peak": 0,
+            "recycle": set(),
+            "recycle_count": 0,
+        },
+        "wait_stat": {
+            "lock": threading.Lock(),
+            "start": datetime.datetime.now(),
+            "total": 0.0,
+            "page": {},
+        },
     }
 
-    load_order_info(handle)
+    handle["tracer"] = local_lib.tracer.create() if get_trace_file_path(handle) is not None else None
 
+    handle["rate_limiter"] = local_lib.rate_limiter.create(
+        {"concurrency": get_worker_count(handle)} | config.get("crawl", {}).get("rate_limit", {})
+    )
+
+    # NOTE: ジャーナルを開くので，読み込みより前にフォルダを作っておく
     prepare_directory(handle)
 
+    load_order_info(handle)
+    load_item_cache(handle)
+
     return handle
 
 
@@ -39,7 +108,12 @@ def prepare_directory(handle):
     get_debug_dir_path(handle).mkdir(parents=True, exist_ok=True)
     get_thumb_dir_path(handle).mkdir(parents=True, exist_ok=True)
     get_caceh_file_path(handle).parent.mkdir(parents=True, exist_ok=True)
+    if get_order_db_file_path(handle) is not None:
+        get_order_db_file_path(handle).parent.mkdir(parents=True, exist_ok=True)
+    get_item_cache_file_path(handle).parent.mkdir(parents=True, exist_ok=True)
     get_excel_file_path(handle).parent.mkdir(parents=True, exist_ok=True)
+    if get_trace_file_path(handle) is not None:
+        get_trace_file_path(handle).parent.mkdir(parents=True, exist_ok=True)
 
 
 def get_excel_font(handle):
@@ -51,10 +125,37 @@ def get_caceh_file_path(handle):
     return pathlib.Path(handle["config"]["base_dir"], handle["config"]["data"]["rakuten"]["cache"]["order"])
 
 
+def get_order_db_file_path(handle):
+    order_db_file = handle["config"]["data"]["rakuten"]["cache"].get("order_db")
+    if order_db_file is None:
+        return None
+
+    return pathlib.Path(handle["config"]["base_dir"], order_db_file)
+
+
+def get_journal_file_path(handle):
+    return get_caceh_file_path(handle).with_suffix(".journal")
+
+
+def get_item_cache_file_path(handle):
+    return pathlib.Path(
+        handle["config"]["base_dir"],
+        handle["config"]["data"]["rakuten"]["cache"].get("item", ITEM_CACHE_FILE_PATH),
+    )
+
+
 def get_excel_file_path(handle):
     return pathlib.Path(handle["config"]["base_dir"], handle["config"]["output"]["excel"]["table"])
 
 
+def get_trace_file_path(handle):
+    trace_file = handle["config"]["output"].get("trace")
+    if trace_file is None:
+        return None
+
+    return pathlib.Path(handle["config"]["base_dir"], trace_file)
+
+
 def get_thumb_dir_path(handle):
     return pathlib.Path(handle["config"]["base_dir"], handle["config"]["data"]["rakuten"]["cache"]["thumb"])
 
@@ -67,42 +168,575 @@ def get_debug_dir_path(handle):
     return pathlib.Path(handle["config"]["base_dir"], handle["config"]["data"]["debug"])
 
 
+def get_worker_count(handle):
+    return handle["config"].get("crawl", {}).get("worker", 1)
+
+
+def get_item_worker_count(handle):
+    return handle["config"].get("crawl", {}).get("item_worker", get_worker_count(handle))
+
+
+def get_thumb_worker_count(handle):
+    return handle["config"].get("crawl", {}).get("thumb_worker", THUMB_WORKER_COUNT)
+
+
+def get_http_pool_size(handle):
+    # NOTE: 同時に HTTP でアクセスするのは，注文一覧の取得・注文と商品とサムネイルの各ワーカー・
+    # 注文件数を調べるスレッド．接続が足りないと，使い終えた接続を捨てて毎回繋ぎ直すことになる
+    return (
+        1
+        + get_worker_count(handle)
+        + get_item_worker_count(handle)
+        + get_thumb_worker_count(handle)
+        + COUNT_WORKER_COUNT
+    )
+
+
+def is_http_enabled(handle):
+    return handle["config"].get("crawl", {}).get("http", False)
+
+
+def trace(handle, name, category="default", **args):
+    return local_lib.tracer.span(handle["tracer"], name, category, **args)
+
+
+def is_keep_cache(handle):
+    return handle["config"].get("crawl", {}).get("keep_cache", False)
+
+
+def get_block_category_list(handle, page_type, default_category_list):
+    return handle["config"].get("crawl", {}).get("block", {}).get(page_type, default_category_list)
+
+
+def set_block_category_list(handle, driver, category_list):
+    # NOTE: 設定が変わらない場合は，CDP のコマンドを発行しない
+    if handle["block_category"].get(id(driver)) == category_list:
+        return False
+
+    local_lib.selenium_util.set_block_url_list(
+        driver, local_lib.selenium_util.gen_block_url_list(category_list)
+    )
+    handle["block_category"][id(driver)] = category_list
+
+    return True
+
+
+def get_daemon_control_port(handle):
+    daemon_config = handle["config"].get("crawl", {}).get("daemon")
+
+    if daemon_config is None:
+        return None
+
+    return daemon_config.get("control_port", local_lib.browser_daemon.CONTROL_PORT)
+
+
+def create_selenium_driver(handle):
+    # NOTE: 常駐している Web ブラウザに接続したかどうかも返す
+    control_port = get_daemon_control_port(handle)
+
+    if control_port is not None:
+        debugger_address = local_lib.browser_daemon.get_debugger_address(
+            get_selenium_data_dir_path(handle), control_port
+        )
+
+        if debugger_address is not None:
+            logging.info("Attach to resident browser: {address}".format(address=debugger_address))
+            return (
+                local_lib.selenium_util.attach_driver(debugger_address, get_selenium_data_dir_path(handle)),
+                True,
+            )
+
+        logging.info("Resident browser is not running, start a new one")
+
+    return (
+        local_lib.selenium_util.create_driver(SELENIUM_PROFILE_NAME, get_selenium_data_dir_path(handle)),
+        False,
+    )
+
+
+def get_rate_limiter(handle):
+    return handle["rate_limiter"]
+
+
+def update_rate_status(handle):
+    metric = local_lib.rate_limiter.get_metric(get_rate_limiter(handle))
+
+    status = (
+        "{rate:.1f} req/s, {active}/{concurrency} 並列, 応答 {latency:.2f} 秒, 失敗 {failure:,} 回".format(
+            rate=metric["rate"],
+            active=metric["active"],
+            concurrency=metric["concurrency"],
+            latency=0.0 if metric["latency"] is None else metric["latency"],
+            failure=metric["failure"],
+        )
+    )
+
+    memory_stat = get_memory_stat(handle)
+    if memory_stat["last"] is not None:
+        status += ", メモリ {memory:,} MB".format(memory=memory_stat["last"])
+
+    if "rate_status" not in handle:
+        handle["rate_status"] = handle["progress_manager"].status_bar(
+            status_format="{fill}{status}{fill}",
+            color="bright_white_on_gray30",
+            justify=enlighten.Justify.CENTER,
+            status=status,
+        )
+    else:
+        handle["rate_status"].update(status=status)
+
+
+def get_http_session(handle):
+    # NOTE: サムネイルのダウンロード等，複数のスレッドから呼ばれる
+    with handle["http_lock"]:
+        if "http" not in handle:
+            handle["http"] = local_lib.http_util.create_session(pool_size=get_http_pool_size(handle))
+
+    return handle["http"]
+
+
+def update_http_cookie(handle):
+    driver, wait = get_selenium_driver(handle)
+
+    local_lib.http_util.set_cookie_list(
+        get_http_session(handle), local_lib.selenium_util.get_cookie_list(driver)
+    )
+
+
+def has_selenium_driver(handle):
+    return "selenium" in handle
+
+
 def get_selenium_driver(handle):
+    # NOTE: ワーカースレッドから呼ばれた場合は，そのスレッドに割り当てられた driver を返す
+    worker = getattr(handle["selenium_local"], "worker", None)
+    if worker is not None:
+        return (worker["driver"], worker["wait"])
+
     if "selenium" in handle:
         return (handle["selenium"]["driver"], handle["selenium"]["wait"])
     else:
-        driver = local_lib.selenium_util.create_driver("Rakhist", get_selenium_data_dir_path(handle))
+        driver, is_attached = create_selenium_driver(handle)
         wait = WebDriverWait(driver, 5)
 
-        local_lib.selenium_util.clear_cache(driver)
+        if not is_keep_cache(handle):
+            local_lib.selenium_util.clear_cache(driver)
 
         handle["selenium"] = {
             "driver": driver,
             "wait": wait,
+            "is_attached": is_attached,
         }
 
+        start_memory_watchdog(handle)
+
         return (driver, wait)
 
 
+def create_selenium_worker(handle, index, cookie_list):
+    profile_name = SELENIUM_WORKER_PROFILE_NAME.format(index=index)
+
+    local_lib.selenium_util.clone_profile(
+        get_selenium_data_dir_path(handle), SELENIUM_PROFILE_NAME, profile_name
+    )
+
+    driver = local_lib.selenium_util.create_driver(profile_name, get_selenium_data_dir_path(handle))
+    local_lib.selenium_util.set_cookie_list(driver, cookie_list)
+
+    return {"driver": driver, "wait": WebDriverWait(driver, 5), "profile_name": profile_name}
+
+
+def get_selenium_worker_pool(handle):
+    if "selenium_worker" in handle:
+        return handle["selenium_worker"]
+
+    # NOTE: ログイン済みのメインの driver から Cookie を引き継ぐ
+    driver, wait = get_selenium_driver(handle)
+    cookie_list = local_lib.selenium_util.get_cookie_list(driver)
+
+    worker_count = get_worker_count(handle)
+    worker_list = []
+    worker_queue = queue.Queue()
+    for i in range(worker_count):
+        worker = create_selenium_worker(handle, i + 1, cookie_list)
+        worker_list.append(worker)
+        worker_queue.put(worker)
+
+    handle["selenium_worker"] = {
+        "list": worker_list,
+        "queue": worker_queue,
+        "executor": concurrent.futures.ThreadPoolExecutor(max_workers=worker_count),
+    }
+
+    return handle["selenium_worker"]
+
+
+def run_on_selenium_worker(handle, func, *args):
+    pool = get_selenium_worker_pool(handle)
+
+    def run():
+        worker = pool["queue"].get()
+        handle["selenium_local"].worker = worker
+        try:
+            return func(handle, *args)
+        finally:
+            handle["selenium_local"].worker = None
+            pool["queue"].put(worker)
+
+    return pool["executor"].submit(run)
+
+
+def get_page_cache(handle, url):
+    return handle["page_cache"].get(url)
+
+
+def set_page_cache(handle, url, page):
+    handle["page_cache"][url] = page
+
+
+def update_session_expire(handle, cookie_list):
+    now = datetime.datetime.now().timestamp()
+
+    expire_list = [
+        cookie["expires"]
+        for cookie in cookie_list
+        if cookie["domain"].endswith(SESSION_COOKIE_DOMAIN)
+        and (not cookie.get("session", False))
+        and (cookie["expires"] > now + SESSION_COOKIE_MIN_SEC)
+    ]
+
+    # NOTE: 期限付きの Cookie が無い場合は，ページ毎の判定のみに頼る
+    if len(expire_list) == 0:
+        handle["session_expire"] = datetime.datetime.max
+    else:
+        handle["session_expire"] = datetime.datetime.fromtimestamp(min(expire_list))
+
+
+def is_session_expired(handle):
+    return (handle["session_expire"] is None) or (datetime.datetime.now() >= handle["session_expire"])
+
+
+def get_memory_limit(handle):
+    return handle["config"].get("crawl", {}).get("memory_limit", MEMORY_LIMIT_MB)
+
+
+def get_driver_list(handle):
+    driver_list = []
+    if "selenium" in handle:
+        driver_list.append(handle["selenium"]["driver"])
+    if "selenium_worker" in handle:
+        driver_list.extend(map(lambda worker: worker["driver"], handle["selenium_worker"]["list"]))
+
+    return driver_list
+
+
+def check_memory(handle):
+    memory_stat = handle["memory_stat"]
+
+    # NOTE: 常駐している Web ブラウザに接続した場合，Chrome は chromedriver の子プロセスではないので，
+    # 計測の対象外になる
+
+    total = 0
+    for driver in get_driver_list(handle):
+        memory = local_lib.selenium_util.get_tree_memory(driver)
+        if memory is None:
+            continue
+
+        total += memory
+
+        if memory > get_memory_limit(handle):
+            with memory_stat["lock"]:
+                memory_stat["recycle"].add(id(driver))
+
+    with memory_stat["lock"]:
+        memory_stat["sample"].append((datetime.datetime.now(), total))
+        memory_stat["peak"] = max(memory_stat["peak"], total)
+
+
+def watch_memory(handle):
+    while not handle["memory_stat"]["stop"].wait(MEMORY_CHECK_INTERVAL_SEC):
+        try:
+            check_memory(handle)
+        except Exception:
+            # NOTE: driver の作り直しと重なった場合等．次の周期で計測し直す
+            logging.debug("Failed to check memory", exc_info=True)
+
+
+def start_memory_watchdog(handle):
+    # NOTE: /proc が無い環境 (Windows 等) では監視しない
+    if not pathlib.Path("/proc").exists():
+        return
+
+    thread = threading.Thread(target=watch_memory, args=(handle,), daemon=True)
+    thread.start()
+
+
+def get_memory_stat(handle):
+    memory_stat = handle["memory_stat"]
+
+    with memory_stat["lock"]:
+        return {
+            "last": memory_stat["sample"][-1][1] if len(memory_stat["sample"]) != 0 else None,
+            "peak": memory_stat["peak"],
+            "recycle_count": memory_stat["recycle_count"],
+            "sample": list(memory_stat["sample"]),
+        }
+
+
+def is_recycle_needed(handle, driver):
+    with handle["memory_stat"]["lock"]:
+        if id(driver) not in handle["memory_stat"]["recycle"]:
+            return False
+
+        handle["memory_stat"]["recycle"].discard(id(driver))
+        handle["memory_stat"]["recycle_count"] += 1
+
+        return True
+
+
+def recreate_selenium_driver(handle, driver, create_func):
+    # NOTE: ログイン状態を引き継ぐため，Cookie を移してから作り直す
+    cookie_list = local_lib.selenium_util.get_cookie_list(driver)
+
+    handle["block_category"].pop(id(driver), None)
+    driver.quit()
+
+    new_driver = create_func()
+    local_lib.selenium_util.set_cookie_list(new_driver, cookie_list)
+
+    return (new_driver, WebDriverWait(new_driver, 5))
+
+
+def recycle_selenium_driver(handle):
+    # NOTE: 注文やページの合間に呼ばれ，使用メモリが上限を超えた driver を作り直す
+    worker = getattr(handle["selenium_local"], "worker", None)
+
+    if worker is not None:
+        if not is_recycle_needed(handle, worker["driver"]):
+            return
+
+        logging.info("Recycle worker browser to reduce memory usage")
+
+        worker["driver"], worker["wait"] = recreate_selenium_driver(
+            handle,
+            worker["driver"],
+            lambda: local_lib.selenium_util.create_driver(
+                worker["profile_name"], get_selenium_data_dir_path(handle)
+            ),
+        )
+    elif "selenium" in handle:
+        if not is_recycle_needed(handle, handle["selenium"]["driver"]):
+            return
+
+        # NOTE: 常駐している Web ブラウザは，driver を終了しても終了しない．接続し直しても
+        # 同じ Web ブラウザに繋がるだけなので，作り直さない
+        if handle["selenium"]["is_attached"]:
+            logging.info("Skip recycling resident browser")
+            return
+
+        logging.info("Recycle browser to reduce memory usage")
+
+        handle["selenium"]["driver"], handle["selenium"]["wait"] = recreate_selenium_driver(
+            handle,
+            handle["selenium"]["driver"],
+            lambda: local_lib.selenium_util.create_driver(
+                SELENIUM_PROFILE_NAME, get_selenium_data_dir_path(handle)
+            ),
+        )
+
+
+def get_wait_timeout(handle, page_type):
+    page_stat = handle["wait_stat"]["page"].get(page_type)
+
+    if page_stat is None:
+        return WAIT_TIMEOUT_MAX
+
+    # NOTE: これまでの待ち時間の傾向から，余裕を持たせたタイムアウトを決める
+    return min(max(page_stat["ewma"] * WAIT_TIMEOUT_RATIO, WAIT_TIMEOUT_MIN), WAIT_TIMEOUT_MAX)
+
+
+def record_wait_time(handle, page_type, sec):
+    with handle["wait_stat"]["lock"]:
+        handle["wait_stat"]["total"] += sec
+
+        page_stat = handle["wait_stat"]["page"].get(page_type)
+        if page_stat is None:
+            handle["wait_stat"]["page"][page_type] = {"count": 1, "total": sec, "ewma": sec}
+        else:
+            page_stat["count"] += 1
+            page_stat["total"] += sec
+            page_stat["ewma"] = (WAIT_EWMA_ALPHA * sec) + ((1 - WAIT_EWMA_ALPHA) * page_stat["ewma"])
+
+
+def get_wait_stat(handle):
+    elapsed = (datetime.datetime.now() - handle["wait_stat"]["start"]).total_seconds()
+
+    return {
+        "elapsed": elapsed,
+        "wait": handle["wait_stat"]["total"],
+        "work": max(elapsed - handle["wait_stat"]["total"], 0),
+        "page": handle["wait_stat"]["page"],
+    }
+
+
+def record_item_impl(order, item):
+    order["item_list"].append(item)
+
+
+def add_retry_order_impl(order, order_info):
+    order.setdefault("retry_order", {})[order_info["no"]] = order_info
+
+
+def remove_retry_order_impl(order, no):
+    order.setdefault("retry_order", {}).pop(no, None)
+
+
+def update_item_category_impl(order, item_id, category):
+    order["item_list"].update_category(item_id, category)
+
+
+def set_year_list_impl(order, year_list):
+    order["year_list"] = year_list
+
+
+def set_order_count_impl(order, year, order_count):
+    order["year_count"][year] = order_count
+
+
+def set_page_checked_impl(order, year, page, order_no_list):
+    if year in order["page_stat"]:
+        order["page_stat"][year][page] = order_no_list
+    else:
+        order["page_stat"][year] = {page: order_no_list}
+
+
+def set_year_checked_impl(order, year):
+    order["year_stat"][year] = True
+
+
+def set_incremental_pending_impl(order, is_pending):
+    order["incremental_pending"] = is_pending
+
+
+def set_last_modified_impl(order, last_modified):
+    order["last_modified"] = last_modified
+
+
+# NOTE: handle["order"] を変更する操作．変更はジャーナルに追記し，読み込み時に同じ関数で再現する
+ORDER_EVENT_FUNC = {
+    "record_item": record_item_impl,
+    "add_retry_order": add_retry_order_impl,
+    "remove_retry_order": remove_retry_order_impl,
+    "update_item_category": update_item_category_impl,
+    "set_year_list": set_year_list_impl,
+    "set_order_count": set_order_count_impl,
+    "set_page_checked": set_page_checked_impl,
+    "set_year_checked": set_year_checked_impl,
+    "set_incremental_pending": set_incremental_pending_impl,
+    "set_last_modified": set_last_modified_impl,
+}
+
+
+def update_order(handle, name, *args):
+    with handle["order_lock"]:
+        ORDER_EVENT_FUNC[name](handle["order"], *args)
+
+        if "order_db" in handle:
+            store_rakuten.order_db.apply(handle["order_db"], name, args)
+        else:
+            local_lib.journal.append(handle["journal"], (name, args))
+
+
 def record_item(handle, item):
-    handle["order"]["item_list"].append(item)
-    handle["order"]["order_no_stat"][item["no"]] = True
+    # NOTE: ジャーナルに巡回中の一時的な項目を書き込まないよう，先に変換しておく
+    update_order(handle, "record_item", store_rakuten.item.create(item))
+
+
+def add_retry_order(handle, order_info):
+    update_order(handle, "add_retry_order", order_info)
+
+
+def remove_retry_order(handle, no):
+    if no in handle["order"].get("retry_order", {}):
+        update_order(handle, "remove_retry_order", no)
+
+
+def get_retry_order_list(handle):
+    # NOTE: 再試行の導入前に保存したデータには，キーが無い
+    return list(handle["order"].get("retry_order", {}).values())
+
+
+def get_item_cache_ttl(handle):
+    return datetime.timedelta(
+        days=handle["config"].get("crawl", {}).get("item_cache_ttl", ITEM_CACHE_TTL_DAY)
+    )
+
+
+def is_item_cache_fresh(handle, entry):
+    return (datetime.datetime.now() - entry["updated"]) < get_item_cache_ttl(handle)
+
+
+def get_item_cache(handle, item_id):
+    entry = handle["item_cache"].get(item_id)
+
+    if (entry is None) or (not is_item_cache_fresh(handle, entry)):
+        return None
+
+    return entry["category"]
+
+
+def set_item_cache(handle, item):
+    handle["item_cache"][item["id"]] = {
+        "category": item["category"],
+        "url": item["url"],
+        "seller": item["seller"],
+        "updated": datetime.datetime.now(),
+    }
+
+
+def update_item_category(handle, item):
+    update_order(handle, "update_item_category", item["id"], item["category"])
+
+
+def get_stale_item_cache_list(handle):
+    return [
+        {"id": item_id, "url": entry["url"], "seller": entry["seller"]}
+        for item_id, entry in handle["item_cache"].items()
+        if not is_item_cache_fresh(handle, entry)
+    ]
 
 
 def get_order_stat(handle, no):
-    return no in handle["order"]["order_no_stat"]
+    return handle["order"]["item_list"].has_order(no)
+
+
+def get_recorded_order_count(handle):
+    return handle["order"]["item_list"].get_order_count()
 
 
 def get_item_list(handle):
-    return sorted(handle["order"]["item_list"], key=lambda x: x["date"])
+    # NOTE: 日付順の並びは store_rakuten.item.ItemList が追加の度に更新している
+    return list(handle["order"]["item_list"].get_sorted_list())
 
 
 def get_last_item(handle, year):
-    return next(filter(lambda item: item["date"].year == year, reversed(get_item_list(handle))), None)
+    return handle["order"]["item_list"].get_last_item(year)
+
+
+def get_order_item_list(handle, no):
+    return handle["order"]["item_list"].get_order_item_list(no)
+
+
+def get_item_list_by_date(handle, start, end):
+    return list(handle["order"]["item_list"].get_item_list_by_date(start, end))
+
+
+def get_item_list_by_seller(handle, seller):
+    return list(handle["order"]["item_list"].get_item_list_by_seller(seller))
 
 
 def set_year_list(handle, year_list):
-    handle["order"]["year_list"] = year_list
+    update_order(handle, "set_year_list", year_list)
 
 
 def get_year_list(handle):
@@ -110,25 +744,34 @@ def get_year_list(handle):
 
 
 def set_order_count(handle, year, order_count):
-    handle["order"]["year_count"][year] = order_count
+    update_order(handle, "set_order_count", year, order_count)
 
 
-def set_page_checked(handle, year, page):
-    if year in handle["order"]["page_stat"]:
-        handle["order"]["page_stat"][year][page] = True
-    else:
-        handle["order"]["page_stat"][year] = {page: True}
+def add_order_count(handle, year, order_count):
+    # NOTE: ジャーナルを再生し直しても結果が変わらないよう，加算後の件数を記録する
+    set_order_count(handle, year, handle["order"]["year_count"].get(year, 0) + order_count)
+
+
+def set_page_checked(handle, year, page, order_no_list):
+    update_order(handle, "set_page_checked", year, page, order_no_list)
 
 
 def get_page_checked(handle, year, page):
-    if (year in handle["order"]["page_stat"]) and (page in handle["order"]["page_stat"][year]):
-        return handle["order"]["page_stat"][year][page]
-    else:
-        return False
+    return (year in handle["order"]["page_stat"]) and (page in handle["order"]["page_stat"][year])
+
+
+def get_page_order_no_list(handle, year, page):
+    order_no_list = handle["order"]["page_stat"][year][page]
+
+    # NOTE: 以前のデータは，巡回済みかどうか (True) しか記録していない
+    if order_no_list is True:
+        return None
+
+    return order_no_list
 
 
 def set_year_checked(handle, year):
-    handle["order"]["year_stat"][year] = True
+    update_order(handle, "set_year_checked", year)
     store_order_info(handle)
 
 
@@ -136,17 +779,34 @@ def get_year_checked(handle, year):
     return year in handle["order"]["year_stat"]
 
 
+def set_incremental_pending(handle, is_pending):
+    update_order(handle, "set_incremental_pending", is_pending)
+    store_order_info(handle)
+
+
+def get_incremental_pending(handle):
+    # NOTE: 差分収集の導入前に保存したデータには，キーが無い
+    return handle["order"].get("incremental_pending", False)
+
+
+def has_order_count(handle, year):
+    return year in handle["order"]["year_count"]
+
+
 def get_order_count(handle, year):
     return handle["order"]["year_count"][year]
 
 
 def get_total_order_count(handle):
-    return functools.reduce(lambda a, b: a + b, handle["order"]["year_count"].values())
+    # NOTE: 件数を並行して調べている間は，一部の年がまだ含まれていないことがある
+    return sum(handle["order"]["year_count"].values())
 
 
 def get_thumb_path(handle, item):
     (get_thumb_dir_path(handle) / item["id"]).parent.mkdir(parents=True, exist_ok=True)
 
+    # NOTE: 画像はダウンロードしたデータをそのまま保存するので，中身が JPEG 等の場合もある．
+    # 既存のキャッシュを活かすため拡張子は .png のままにしている．(openpyxl は中身で形式を判定する)
     return get_thumb_dir_path(handle) / (item["id"] + ".png")
 
 
@@ -187,33 +847,165 @@ def set_status(handle, status, is_error=False):
 
 
 def finish(handle):
+    handle["memory_stat"]["stop"].set()
+
+    close_order_info(handle)
+
+    if "selenium_worker" in handle:
+        handle["selenium_worker"]["executor"].shutdown(cancel_futures=True)
+        for worker in handle["selenium_worker"]["list"]:
+            worker["driver"].quit()
+        handle.pop("selenium_worker")
+
+    if "http" in handle:
+        handle["http"].close()
+        handle.pop("http")
+
     if "selenium" in handle:
         handle["selenium"]["driver"].quit()
         handle.pop("selenium")
 
+    if handle["tracer"] is not None:
+        event_count = local_lib.tracer.dump(handle["tracer"], get_trace_file_path(handle))
+        logging.info(
+            "Write {count:,} trace events to {path}".format(
+                count=event_count, path=get_trace_file_path(handle)
+            )
+        )
+
     handle["progress_manager"].stop()
 
 
+def compact_order_info(handle):
+    # NOTE: スナップショットには，どの世代のジャーナルまで反映済みかを記録する．
+    # スナップショットを書いた後，ジャーナルを空にする前に落ちた場合も，二重に再生しないようにするため．
+    with handle["order_lock"]:
+        generation = handle["order"].get("journal_generation", 0)
+        handle["order"]["journal_generation"] = generation + 1
+
+        if not local_lib.serializer.store(
+            get_caceh_file_path(handle), handle["order"], schema_version=ORDER_INFO_SCHEMA_VERSION
+        ):
+            # NOTE: ジャーナルは消さずに残し，次の機会に書き出し直す
+            handle["order"]["journal_generation"] = generation
+            local_lib.journal.sync(handle["journal"])
+            return
+
+        local_lib.serializer.store(
+            get_item_cache_file_path(handle), handle["item_cache"], schema_version=ITEM_CACHE_SCHEMA_VERSION
+        )
+
+        local_lib.journal.reset(handle["journal"], ("journal", generation + 1))
+
+
+def is_compact_needed(handle):
+    cache_file_path = get_caceh_file_path(handle)
+    snapshot_size = cache_file_path.stat().st_size if cache_file_path.exists() else 0
+
+    return local_lib.journal.get_size(handle["journal"]) > max(JOURNAL_COMPACT_SIZE_MIN, snapshot_size)
+
+
 def store_order_info(handle):
-    handle["order"]["last_modified"] = datetime.datetime.now()
+    # NOTE: 変更はジャーナルに追記済みなので，ここでは確実にディスクに書き出すだけにする．
+    # 全体の書き出しは，ジャーナルが大きくなった時のみ行う．商品情報のキャッシュも同じ時に書き出すが，
+    # 落ちて失われた分は，load_item_cache で注文履歴に記録されているカテゴリから補われる．
+    with trace(handle, "store_order_info", "store"):
+        update_order(handle, "set_last_modified", datetime.datetime.now())
+
+        if "order_db" in handle:
+            store_rakuten.order_db.commit(handle["order_db"])
+        elif is_compact_needed(handle):
+            compact_order_info(handle)
+        else:
+            local_lib.journal.sync(handle["journal"])
+
+
+def close_order_info(handle):
+    if "order_db" in handle:
+        local_lib.serializer.store(
+            get_item_cache_file_path(handle), handle["item_cache"], schema_version=ITEM_CACHE_SCHEMA_VERSION
+        )
+        store_rakuten.order_db.close(handle["order_db"])
+        handle.pop("order_db")
+
+    if "journal" in handle:
+        compact_order_info(handle)
+        local_lib.journal.close(handle["journal"])
+        handle.pop("journal")
+
+
+def gen_order_info_init_value():
+    return {
+        "year_list": [],
+        "year_count": {},
+        "year_stat": {},
+        "page_stat": {},
+        "item_list": store_rakuten.item.ItemList(),
+        "incremental_pending": False,
+        "retry_order": {},
+        "last_modified": datetime.datetime(1994, 7, 5),
+    }
 
-    local_lib.serializer.store(get_caceh_file_path(handle), handle["order"])
 
+def replay_journal(order, journal_file_path):
+    generation = order.get("journal_generation", 0)
 
-def load_order_info(handle):
-    handle["order"] = local_lib.serializer.load(
-        get_caceh_file_path(handle),
-        {
-            "year_list": [],
-            "year_count": {},
-            "year_stat": {},
-            "page_stat": {},
-            "item_list": [],
-            "order_no_stat": {},
-            "last_modified": datetime.datetime(1994, 7, 5),
-        },
+    record_list, valid_size = local_lib.journal.load(journal_file_path)
+
+    if (len(record_list) == 0) or (record_list[0] != ("journal", generation)):
+        # NOTE: スナップショットに反映済みの古い世代のジャーナル．スナップショットが壊れていて
+        # 以前の世代を読み込んだ場合も，間の変更が抜けた状態で再生しないよう，ここで捨てる
+        return 0
+
+    for name, args in record_list[1:]:
+        ORDER_EVENT_FUNC[name](order, *args)
+
+    if len(record_list) > 1:
+        logging.info("Replay {count:,} journal records".format(count=len(record_list) - 1))
+
+    return valid_size
+
+
+def load_order_snapshot(handle):
+    order = local_lib.serializer.load(
+        get_caceh_file_path(handle), gen_order_info_init_value(), ORDER_INFO_SCHEMA_VERSION
     )
 
+    # NOTE: 辞書のリストで保存していた以前のデータは変換する．
+    # 注文番号の一覧 (order_no_stat) は，ItemList の索引で代わりが効くので捨てる
+    if not isinstance(order["item_list"], store_rakuten.item.ItemList):
+        order["item_list"] = store_rakuten.item.ItemList(order["item_list"])
+    order.pop("order_no_stat", None)
+
+    return order
+
+
+def load_order_db(handle):
+    db = store_rakuten.order_db.open_db(get_order_db_file_path(handle))
+
+    # NOTE: 初めてデータベースを使う場合は，これまでのキャッシュを取り込む
+    if store_rakuten.order_db.is_empty(db) and get_caceh_file_path(handle).exists():
+        order = load_order_snapshot(handle)
+        replay_journal(order, get_journal_file_path(handle))
+        store_rakuten.order_db.import_order(db, order)
+
+    handle["order_db"] = db
+    handle["order"] = store_rakuten.order_db.load(db, gen_order_info_init_value())
+
+
+def load_order_info(handle):
+    if get_order_db_file_path(handle) is not None:
+        load_order_db(handle)
+    else:
+        handle["order"] = load_order_snapshot(handle)
+
+        journal_file_path = get_journal_file_path(handle)
+        handle["journal"] = local_lib.journal.start(
+            journal_file_path,
+            replay_journal(handle["order"], journal_file_path),
+            ("journal", handle["order"].get("journal_generation", 0)),
+        )
+
     # NOTE: 再開した時には巡回すべきなので削除しておく
     for year in [
         datetime.datetime.now().year,
@@ -223,5 +1015,24 @@ def load_order_info(handle):
             del handle["order"]["page_stat"][year]
 
 
+def load_item_cache(handle):
+    handle["item_cache"] = local_lib.serializer.load(
+        get_item_cache_file_path(handle), {}, ITEM_CACHE_SCHEMA_VERSION
+    )
+
+    # NOTE: キャッシュ導入前に収集した商品は，注文履歴に記録されているカテゴリを使う．
+    # データベースの場合に全ての商品を読み出さないよう，キャッシュに無い商品のみ取り出す
+    for item in handle["order"]["item_list"].get_item_list_excluding_id(handle["item_cache"]):
+        if (item["id"] in handle["item_cache"]) or ("category" not in item):
+            continue
+
+        handle["item_cache"][item["id"]] = {
+            "category": item["category"],
+            "url": item["url"],
+            "seller": item["seller"],
+            "updated": get_cache_last_modified(handle),
+        }
+
+
 def get_progress_bar(handle, desc):
     return handle["progress_bar"][desc]
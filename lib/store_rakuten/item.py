@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# NOTE: 購入した商品は数万件になることがあるので，辞書ではなく __slots__ を持つクラスで保持する．
+# ストア名・カテゴリ・日付は多くの商品で同じ値になるので，ItemList の中で 1 つのオブジェクトを共有する．
+# Excel の出力 (local_lib.openpyxl_util) 等からは，従来の辞書と同様に item[key] や key in item で参照できる．
+#
+# ItemList は，日付順の並び・年毎の最新の商品・注文番号や商品 ID 毎の商品を，追加の度に更新する．
+# 巡回中に何度も全体を並べ替えずに済むようにするため．
+
+import bisect
+import operator
+
+FIELD_LIST = ["date", "no", "seller", "name", "price", "count", "url", "id", "include_tax", "category"]
+FIELD_SET = frozenset(FIELD_LIST)
+
+DATE_KEY = operator.attrgetter("date")
+
+# NOTE: 共有する値．書籍の商品には include_tax が無い等，項目の有無は商品によって異なる
+SHARED_FIELD_LIST = ["date", "no", "seller", "category"]
+
+
+def restore(field_mask, value_list):
+    item = Item()
+    value_iter = iter(value_list)
+    for i, key in enumerate(FIELD_LIST):
+        if field_mask & (1 << i):
+            setattr(item, key, next(value_iter))
+
+    return item
+
+
+class Item:
+    __slots__ = FIELD_LIST
+
+    def __init__(self, **field):
+        for key, value in field.items():
+            setattr(self, key, value)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == "category":
+            value = tuple(value)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return (key in FIELD_SET) and hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in FIELD_SET else default
+
+    def keys(self):
+        return [key for key in FIELD_LIST if hasattr(self, key)]
+
+    def __repr__(self):
+        return "Item({field})".format(
+            field=", ".join("{k}={v!r}".format(k=k, v=self[k]) for k in self.keys())
+        )
+
+    def __reduce__(self):
+        # NOTE: 項目名を商品毎に保存しないよう，有無のビットと値の並びで保存する
+        field_mask = 0
+        value_list = []
+        for i, key in enumerate(FIELD_LIST):
+            if hasattr(self, key):
+                field_mask |= 1 << i
+                value_list.append(getattr(self, key))
+
+        return (restore, (field_mask, tuple(value_list)))
+
+
+def create(item):
+    # NOTE: 巡回中の商品は辞書で，サムネイルの URL 等の一時的な項目を含むので，必要な項目のみ取り出す
+    record = Item(**{key: item[key] for key in FIELD_LIST if key in item})
+    if "category" in record:
+        record.category = tuple(record.category)
+
+    return record
+
+
+class ItemList:
+    def __init__(self, item_list=[]):
+        self.item_list = []
+        self.pool = {}
+        self.clear_index()
+
+        for item in item_list:
+            self.append(item)
+
+    def clear_index(self):
+        self.date_list = []
+        self.year_last = {}
+        self.no_index = {}
+        self.id_index = {}
+
+    def add_index(self, item):
+        # NOTE: 日付が同じ商品は追加した順に並べる (sorted() で安定ソートした場合と同じ)
+        bisect.insort_right(self.date_list, item, key=DATE_KEY)
+
+        self.update_index(item)
+
+    def update_index(self, item):
+        year = item.date.year
+        if (year not in self.year_last) or (item.date >= self.year_last[year].date):
+            self.year_last[year] = item
+
+        self.no_index.setdefault(item["no"], []).append(item)
+        self.id_index.setdefault(item["id"], []).append(item)
+
+    def share(self, value):
+        return self.pool.setdefault(value, value)
+
+    def share_field(self, item):
+        for key in SHARED_FIELD_LIST:
+            if hasattr(item, key):
+                setattr(item, key, self.share(getattr(item, key)))
+
+    def append(self, item):
+        record = item if isinstance(item, Item) else create(item)
+        if "category" in record:
+            record.category = tuple(map(self.share, record.category))
+        self.share_field(record)
+
+        self.item_list.append(record)
+        self.add_index(record)
+
+        return record
+
+    def update_category(self, item_id, category):
+        category = self.share(tuple(map(self.share, category)))
+
+        for item in self.id_index.get(item_id, []):
+            item.category = category
+
+    def get_sorted_list(self):
+        return self.date_list
+
+    def get_last_item(self, year):
+        return self.year_last.get(year)
+
+    def get_item_list_by_date(self, start, end):
+        return self.date_list[
+            bisect.bisect_left(self.date_list, start, key=DATE_KEY) : bisect.bisect_left(
+                self.date_list, end, key=DATE_KEY
+            )
+        ]
+
+    def get_item_list_by_seller(self, seller):
+        return [item for item in self.date_list if item.get("seller") == seller]
+
+    def get_item_list_excluding_id(self, id_set):
+        return [item for item in self.item_list if item["id"] not in id_set]
+
+    def get_order_item_list(self, no):
+        return self.no_index.get(no, [])
+
+    def has_order(self, no):
+        return no in self.no_index
+
+    def get_order_count(self):
+        return len(self.no_index)
+
+    def __iter__(self):
+        return iter(self.item_list)
+
+    def __reversed__(self):
+        return reversed(self.item_list)
+
+    def __len__(self):
+        return len(self.item_list)
+
+    def __getitem__(self, index):
+        return self.item_list[index]
+
+    def __getstate__(self):
+        return {"item_list": self.item_list}
+
+    def __setstate__(self, state):
+        self.item_list = state["item_list"]
+        self.pool = {}
+
+        # NOTE: 保存時に共有していた値は pickle が共有したまま復元するが，以降に追加する商品とも共有する
+        for item in self.item_list:
+            if "category" in item:
+                item.category = tuple(map(self.share, item.category))
+            self.share_field(item)
+
+        # NOTE: 索引は保存せず，読み込み時に作り直す
+        self.clear_index()
+        self.date_list = sorted(self.item_list, key=DATE_KEY)
+        for item in self.date_list:
+            self.update_index(item)
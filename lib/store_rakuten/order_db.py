@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# NOTE: 注文履歴を SQLite (WAL モード) に保存する．設定の data.rakuten.cache.order_db を指定した場合に使う．
+#
+# 商品は ItemTable が直接テーブルに読み書きし，メモリには保持しない．store_rakuten.item.ItemList と
+# 同じ操作ができるので，store_rakuten.handle からはどちらも handle["order"]["item_list"] として扱う．
+# 年の一覧・件数・ページの巡回状況等は小さいので，従来通り handle["order"] に保持し，変更をテーブルにも書く．
+#
+# 変更は store_rakuten.handle.store_order_info が呼ばれる区切り毎にコミットする．
+
+import datetime
+import json
+import logging
+import pickle
+import sqlite3
+import threading
+
+import store_rakuten.item
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS item (
+    date TEXT NOT NULL,
+    no TEXT NOT NULL,
+    seller TEXT,
+    name TEXT,
+    price INTEGER,
+    count INTEGER,
+    url TEXT,
+    id TEXT,
+    include_tax INTEGER,
+    category TEXT
+);
+CREATE INDEX IF NOT EXISTS item_date ON item (date);
+CREATE INDEX IF NOT EXISTS item_no ON item (no);
+CREATE INDEX IF NOT EXISTS item_id ON item (id);
+CREATE INDEX IF NOT EXISTS item_seller ON item (seller);
+
+CREATE TABLE IF NOT EXISTS year_stat (
+    year INTEGER PRIMARY KEY,
+    count INTEGER,
+    checked INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS page_stat (
+    year INTEGER NOT NULL,
+    page INTEGER NOT NULL,
+    order_no_list TEXT,
+    PRIMARY KEY (year, page)
+);
+
+CREATE TABLE IF NOT EXISTS retry_order (
+    no TEXT PRIMARY KEY,
+    order_info BLOB NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL
+);
+"""
+
+ITEM_COLUMN_LIST = ["date", "no", "seller", "name", "price", "count", "url", "id", "include_tax", "category"]
+# NOTE: 書籍の商品には include_tax が無い等，項目自体が無い場合がある．NULL は項目が無いことを表す
+ITEM_OPTIONAL_COLUMN_SET = {"include_tax", "category"}
+
+ITEM_SELECT = "SELECT {column} FROM item".format(column=", ".join(ITEM_COLUMN_LIST))
+ITEM_INSERT = "INSERT INTO item ({column}) VALUES ({value})".format(
+    column=", ".join(ITEM_COLUMN_LIST), value=", ".join(["?"] * len(ITEM_COLUMN_LIST))
+)
+
+
+def open_db(db_path):
+    conn = sqlite3.connect(str(db_path), check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # NOTE: WAL モードでは，NORMAL でもコミット済みのデータが壊れることは無い (電源断で直近の分が失われるのみ)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+
+    db = {"conn": conn, "lock": threading.RLock()}
+
+    if get_meta(db, "schema_version") is None:
+        set_meta(db, "schema_version", SCHEMA_VERSION)
+        commit(db)
+
+    return db
+
+
+def commit(db):
+    with db["lock"]:
+        db["conn"].commit()
+
+
+def close(db):
+    with db["lock"]:
+        db["conn"].commit()
+        db["conn"].close()
+
+
+def execute(db, sql, param=()):
+    with db["lock"]:
+        return db["conn"].execute(sql, param).fetchall()
+
+
+def get_meta(db, key, default=None):
+    row_list = execute(db, "SELECT value FROM meta WHERE key = ?", (key,))
+
+    return pickle.loads(row_list[0][0]) if len(row_list) != 0 else default
+
+
+def set_meta(db, key, value):
+    execute(
+        db,
+        "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+        (key, pickle.dumps(value)),
+    )
+
+
+def encode_date(date):
+    return date.isoformat(" ")
+
+
+def encode_item(item):
+    row = []
+    for key in ITEM_COLUMN_LIST:
+        value = item.get(key)
+        if value is None:
+            row.append(None)
+        elif key == "date":
+            row.append(encode_date(value))
+        elif key == "category":
+            row.append(json.dumps(list(value), ensure_ascii=False))
+        elif key == "include_tax":
+            row.append(int(value))
+        else:
+            row.append(value)
+
+    return row
+
+
+def decode_item(row):
+    field = {}
+    for key, value in zip(ITEM_COLUMN_LIST, row):
+        if value is None:
+            if key not in ITEM_OPTIONAL_COLUMN_SET:
+                field[key] = None
+        elif key == "date":
+            field[key] = datetime.datetime.fromisoformat(value)
+        elif key == "category":
+            field[key] = tuple(json.loads(value))
+        elif key == "include_tax":
+            field[key] = bool(value)
+        else:
+            field[key] = value
+
+    return store_rakuten.item.Item(**field)
+
+
+class ItemTable:
+    def __init__(self, db):
+        self.db = db
+
+    def query(self, where="", param=()):
+        return list(map(decode_item, execute(self.db, ITEM_SELECT + " " + where, param)))
+
+    def append(self, item):
+        execute(self.db, ITEM_INSERT, encode_item(item))
+
+    def extend(self, item_list):
+        with self.db["lock"]:
+            self.db["conn"].executemany(ITEM_INSERT, map(encode_item, item_list))
+
+    def update_category(self, item_id, category):
+        execute(
+            self.db,
+            "UPDATE item SET category = ? WHERE id = ?",
+            (json.dumps(list(category), ensure_ascii=False), item_id),
+        )
+
+    def get_sorted_list(self):
+        # NOTE: 日付が同じ商品は追加した順に並べる (store_rakuten.item.ItemList と同じ)
+        return self.query("ORDER BY date, rowid")
+
+    def get_item_list_by_date(self, start, end):
+        return self.query(
+            "WHERE date >= ? AND date < ? ORDER BY date, rowid", (encode_date(start), encode_date(end))
+        )
+
+    def get_item_list_by_seller(self, seller):
+        return self.query("WHERE seller = ? ORDER BY date, rowid", (seller,))
+
+    def get_last_item(self, year):
+        item_list = self.query(
+            "WHERE date >= ? AND date < ? ORDER BY date DESC, rowid DESC LIMIT 1",
+            (encode_date(datetime.datetime(year, 1, 1)), encode_date(datetime.datetime(year + 1, 1, 1))),
+        )
+
+        return item_list[0] if len(item_list) != 0 else None
+
+    def get_item_list_excluding_id(self, id_set):
+        # NOTE: 除外する ID は商品の数だけあるので，一時テーブルに入れて SQLite 側で絞り込む．
+        # カテゴリの無い商品は呼び出し側で使わないので，ここで除いておく
+        with self.db["lock"]:
+            conn = self.db["conn"]
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS exclude_id (id TEXT PRIMARY KEY)")
+            conn.executemany(
+                "INSERT OR IGNORE INTO exclude_id (id) VALUES (?)", ((item_id,) for item_id in id_set)
+            )
+            row_list = conn.execute(
+                ITEM_SELECT
+                + " WHERE category IS NOT NULL AND id NOT IN (SELECT id FROM exclude_id) ORDER BY rowid"
+            ).fetchall()
+            conn.execute("DELETE FROM exclude_id")
+
+        return list(map(decode_item, row_list))
+
+    def get_order_item_list(self, no):
+        return self.query("WHERE no = ? ORDER BY rowid", (no,))
+
+    def has_order(self, no):
+        return len(execute(self.db, "SELECT 1 FROM item WHERE no = ? LIMIT 1", (no,))) != 0
+
+    def get_order_count(self):
+        return execute(self.db, "SELECT COUNT(DISTINCT no) FROM item")[0][0]
+
+    def __iter__(self):
+        # NOTE: 全件をメモリに載せないよう，少しずつ読み出す
+        with self.db["lock"]:
+            cursor = self.db["conn"].execute(ITEM_SELECT + " ORDER BY rowid")
+        while True:
+            with self.db["lock"]:
+                row_list = cursor.fetchmany(1000)
+            if len(row_list) == 0:
+                break
+            yield from map(decode_item, row_list)
+
+    def __len__(self):
+        return execute(self.db, "SELECT COUNT(*) FROM item")[0][0]
+
+
+def set_year_list(db, year_list):
+    set_meta(db, "year_list", year_list)
+
+
+def set_order_count(db, year, order_count):
+    execute(
+        db,
+        "INSERT INTO year_stat (year, count) VALUES (?, ?) "
+        + "ON CONFLICT (year) DO UPDATE SET count = excluded.count",
+        (year, order_count),
+    )
+
+
+def set_page_checked(db, year, page, order_no_list):
+    execute(
+        db,
+        "INSERT OR REPLACE INTO page_stat (year, page, order_no_list) VALUES (?, ?, ?)",
+        (year, page, json.dumps(order_no_list)),
+    )
+
+
+def set_year_checked(db, year):
+    execute(
+        db,
+        "INSERT INTO year_stat (year, checked) VALUES (?, 1) ON CONFLICT (year) DO UPDATE SET checked = 1",
+        (year,),
+    )
+
+
+def set_incremental_pending(db, is_pending):
+    set_meta(db, "incremental_pending", is_pending)
+
+
+def set_last_modified(db, last_modified):
+    set_meta(db, "last_modified", last_modified)
+
+
+def add_retry_order(db, order_info):
+    execute(
+        db,
+        "INSERT OR REPLACE INTO retry_order (no, order_info) VALUES (?, ?)",
+        (order_info["no"], pickle.dumps(order_info)),
+    )
+
+
+def remove_retry_order(db, no):
+    execute(db, "DELETE FROM retry_order WHERE no = ?", (no,))
+
+
+# NOTE: 商品の追加・カテゴリの更新は ItemTable が直接書き込むので，ここには含めない
+EVENT_FUNC = {
+    "set_year_list": set_year_list,
+    "set_order_count": set_order_count,
+    "set_page_checked": set_page_checked,
+    "set_year_checked": set_year_checked,
+    "set_incremental_pending": set_incremental_pending,
+    "set_last_modified": set_last_modified,
+    "add_retry_order": add_retry_order,
+    "remove_retry_order": remove_retry_order,
+}
+
+
+def apply(db, name, args):
+    if name in EVENT_FUNC:
+        EVENT_FUNC[name](db, *args)
+
+
+def load(db, init_value):
+    order = init_value.copy()
+
+    order["year_list"] = get_meta(db, "year_list", order["year_list"])
+    order["incremental_pending"] = get_meta(db, "incremental_pending", order["incremental_pending"])
+    order["last_modified"] = get_meta(db, "last_modified", order["last_modified"])
+
+    order["year_count"] = {}
+    order["year_stat"] = {}
+    for year, count, checked in execute(db, "SELECT year, count, checked FROM year_stat"):
+        if count is not None:
+            order["year_count"][year] = count
+        if checked:
+            order["year_stat"][year] = True
+
+    order["page_stat"] = {}
+    for year, page, order_no_list in execute(db, "SELECT year, page, order_no_list FROM page_stat"):
+        order["page_stat"].setdefault(year, {})[page] = json.loads(order_no_list)
+
+    order["retry_order"] = {
+        no: pickle.loads(order_info)
+        for no, order_info in execute(db, "SELECT no, order_info FROM retry_order")
+    }
+
+    order["item_list"] = ItemTable(db)
+
+    return order
+
+
+def is_empty(db):
+    return get_meta(db, "last_modified") is None
+
+
+def import_order(db, order):
+    logging.info("Import {count:,} items into the database".format(count=len(order["item_list"])))
+
+    with db["lock"]:
+        ItemTable(db).extend(order["item_list"])
+
+        set_year_list(db, order["year_list"])
+        for year, count in order["year_count"].items():
+            set_order_count(db, year, count)
+        for year in order["year_stat"].keys():
+            set_year_checked(db, year)
+        for year, page_map in order["page_stat"].items():
+            for page, order_no_list in page_map.items():
+                set_page_checked(db, year, page, order_no_list)
+        for order_info in order.get("retry_order", {}).values():
+            add_retry_order(db, order_info)
+        set_incremental_pending(db, order.get("incremental_pending", False))
+        set_last_modified(db, order["last_modified"])
+
+        commit(db)
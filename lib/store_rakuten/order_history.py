@@ -115,16 +115,17 @@ def generate_sheet(handle, book, is_need_thumb=True):
 
     store_rakuten.handle.set_progress_bar(handle, STATUS_INSERT_ITEM, len(item_list))
 
-    local_lib.openpyxl_util.generate_list_sheet(
-        book,
-        item_list,
-        SHEET_DEF,
-        is_need_thumb,
-        lambda item: store_rakuten.handle.get_thumb_path(handle, item),
-        lambda status: store_rakuten.handle.set_status(handle, status),
-        lambda: store_rakuten.handle.get_progress_bar(handle, STATUS_ALL).update(),
-        lambda: store_rakuten.handle.get_progress_bar(handle, STATUS_INSERT_ITEM).update(),
-    )
+    with store_rakuten.handle.trace(handle, "generate_sheet", "export", count=len(item_list)):
+        local_lib.openpyxl_util.generate_list_sheet(
+            book,
+            item_list,
+            SHEET_DEF,
+            is_need_thumb,
+            lambda item: store_rakuten.handle.get_thumb_path(handle, item),
+            lambda status: store_rakuten.handle.set_status(handle, status),
+            lambda: store_rakuten.handle.get_progress_bar(handle, STATUS_ALL).update(),
+            lambda: store_rakuten.handle.get_progress_bar(handle, STATUS_INSERT_ITEM).update(),
+        )
 
 
 def generate_table_excel(handle, excel_file, is_need_thumb=True):
@@ -144,7 +145,8 @@ def generate_table_excel(handle, excel_file, is_need_thumb=True):
 
     store_rakuten.handle.set_status(handle, "エクセルファイルを書き出しています...")
 
-    book.save(excel_file)
+    with store_rakuten.handle.trace(handle, "save_excel", "export"):
+        book.save(excel_file)
 
     store_rakuten.handle.get_progress_bar(handle, STATUS_ALL).update()
 
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+楽天の注文履歴・注文詳細・商品ページの HTML を解析します．
+local_lib.selenium_util.dump_page で保存した .htm ファイルの解析にも使えます．
+
+Usage:
+  parser.py [-n COUNT] FILE...
+
+Options:
+  -n COUNT      : 解析時間を計測する際の繰り返し回数を指定します．[default: 1]
+"""
+
+import datetime
+import re
+
+import lxml.etree
+import lxml.html
+
+import store_rakuten.const
+
+SELLER_BOOK = "楽天ブックス"
+
+# NOTE: 各要素の XPath．Web ブラウザから取り出す場合 (store_rakuten.crawler) も同じ文字列を使うので，
+# ページの構造が変わった場合はここだけ直せば済む
+LOGIN_BOX_XPATH = '//table[contains(@class, "loginBox")]'
+
+YEAR_OPTION_XPATH = '//select[@id="selectPeriodYear"]/option[contains(@value, "20")]'
+NO_ITEM_XPATH = '//div[contains(@class, "noItem")]'
+TOTAL_ITEM_XPATH = '//div[contains(@class, "oDrPager")]//span[contains(@class, "totalItem")]'
+
+ORDER_LIST_XPATH = '//div[contains(@class, "oDrListItem") and table]'
+ORDER_LIST_DATE_XPATH = './/li[contains(@class, "purchaseDate")]'
+ORDER_LIST_NO_XPATH = ".//li[contains(@class, 'orderID')]/span[contains(@class, 'idNum')]"
+ORDER_LIST_SELLER_XPATH = ".//li[contains(@class, 'shopName')]/a"
+ORDER_LIST_URL_XPATH = ".//li[contains(@class, 'oDrDetailList')]/a"
+
+ORDER_ERROR_XPATH = '//ul[contains(@class, "mypage_cxl_mordal_text_error")]'
+
+ORDER_BOOK_DATE_XPATH = '//div[contains(@class, "order-info__date")]'
+ORDER_BOOK_NO_XPATH = (
+    '//div[contains(@class, "order-info__detail")]/span[contains(@class, "order-info__number")]'
+)
+ORDER_BOOK_ITEM_XPATH = '//div[contains(@class, "shipping-list")]//li[contains(@class, "item")]'
+ORDER_BOOK_ITEM_LINK_XPATH = './/h2[contains(@class, "item-detail__title")]/a'
+ORDER_BOOK_ITEM_PRICE_XPATH = (
+    './/div[contains(@class, "item-detail__price")]/span[contains(@class, "item-detail__price-num")]'
+)
+ORDER_BOOK_ITEM_COUNT_XPATH = (
+    './/div[contains(@class, "item-detail__order")]/span[contains(@class, "item-detail__order-num")]'
+)
+ORDER_BOOK_ITEM_THUMB_XPATH = './/div[contains(@class, "item-image")]//img'
+
+ORDER_DEFAULT_DATE_XPATH = '//div[contains(@class, "oDrSpecOrderInfo")]//td[contains(@class, "orderDate")]'
+ORDER_DEFAULT_NO_XPATH = '//div[contains(@class, "oDrSpecOrderInfo")]//td[contains(@class, "orderID")]'
+ORDER_DEFAULT_ITEM_XPATH = (
+    '//div[contains(@class, "oDrSpecPurchaseInfo")]'
+    + '//tr[contains(@valign, "top") and td[contains(@class, "prodInfo")]]'
+)
+ORDER_DEFAULT_ITEM_LINK_XPATH = './/td[contains(@class, "prodName")]/a'
+ORDER_DEFAULT_ITEM_PRICE_XPATH = './/td[contains(@class, "widthPrice")]'
+ORDER_DEFAULT_ITEM_COUNT_XPATH = './/td[contains(@class, "widthQuantity")]'
+ORDER_DEFAULT_ITEM_TAX_XPATH = './/td[contains(@class, "widthTax")]'
+ORDER_DEFAULT_ITEM_THUMB_XPATH = './/td[contains(@class, "prodImg")]//img'
+
+ITEM_BOOK_BREADCRUMB_XPATH = '//dd[@itemprop="breadcrumb"]/a'
+ITEM_DEFAULT_BREADCRUMB_XPATH = '//td[@class="sdtext"]/a'
+
+# NOTE: XPath は事前にコンパイルしておき，解析の度に構文解析しないようにする
+XPATH_LOGIN_BOX = lxml.etree.XPath(LOGIN_BOX_XPATH)
+
+XPATH_YEAR_OPTION = lxml.etree.XPath(YEAR_OPTION_XPATH)
+XPATH_NO_ITEM = lxml.etree.XPath(NO_ITEM_XPATH)
+XPATH_TOTAL_ITEM = lxml.etree.XPath(TOTAL_ITEM_XPATH)
+
+XPATH_ORDER_LIST = lxml.etree.XPath(ORDER_LIST_XPATH)
+XPATH_ORDER_LIST_DATE = lxml.etree.XPath(ORDER_LIST_DATE_XPATH)
+XPATH_ORDER_LIST_NO = lxml.etree.XPath(ORDER_LIST_NO_XPATH)
+XPATH_ORDER_LIST_SELLER = lxml.etree.XPath(ORDER_LIST_SELLER_XPATH)
+XPATH_ORDER_LIST_URL = lxml.etree.XPath(ORDER_LIST_URL_XPATH)
+
+XPATH_ORDER_ERROR = lxml.etree.XPath(ORDER_ERROR_XPATH)
+
+XPATH_ORDER_BOOK_DATE = lxml.etree.XPath(ORDER_BOOK_DATE_XPATH)
+XPATH_ORDER_BOOK_NO = lxml.etree.XPath(ORDER_BOOK_NO_XPATH)
+XPATH_ORDER_BOOK_ITEM = lxml.etree.XPath(ORDER_BOOK_ITEM_XPATH)
+XPATH_ORDER_BOOK_ITEM_LINK = lxml.etree.XPath(ORDER_BOOK_ITEM_LINK_XPATH)
+XPATH_ORDER_BOOK_ITEM_PRICE = lxml.etree.XPath(ORDER_BOOK_ITEM_PRICE_XPATH)
+XPATH_ORDER_BOOK_ITEM_COUNT = lxml.etree.XPath(ORDER_BOOK_ITEM_COUNT_XPATH)
+XPATH_ORDER_BOOK_ITEM_THUMB = lxml.etree.XPath(ORDER_BOOK_ITEM_THUMB_XPATH)
+
+XPATH_ORDER_DEFAULT_DATE = lxml.etree.XPath(ORDER_DEFAULT_DATE_XPATH)
+XPATH_ORDER_DEFAULT_NO = lxml.etree.XPath(ORDER_DEFAULT_NO_XPATH)
+XPATH_ORDER_DEFAULT_ITEM = lxml.etree.XPath(ORDER_DEFAULT_ITEM_XPATH)
+XPATH_ORDER_DEFAULT_ITEM_LINK = lxml.etree.XPath(ORDER_DEFAULT_ITEM_LINK_XPATH)
+XPATH_ORDER_DEFAULT_ITEM_PRICE = lxml.etree.XPath(ORDER_DEFAULT_ITEM_PRICE_XPATH)
+XPATH_ORDER_DEFAULT_ITEM_COUNT = lxml.etree.XPath(ORDER_DEFAULT_ITEM_COUNT_XPATH)
+XPATH_ORDER_DEFAULT_ITEM_TAX = lxml.etree.XPath(ORDER_DEFAULT_ITEM_TAX_XPATH)
+XPATH_ORDER_DEFAULT_ITEM_THUMB = lxml.etree.XPath(ORDER_DEFAULT_ITEM_THUMB_XPATH)
+
+XPATH_ITEM_BOOK_BREADCRUMB = lxml.etree.XPath(ITEM_BOOK_BREADCRUMB_XPATH)
+XPATH_ITEM_DEFAULT_BREADCRUMB = lxml.etree.XPath(ITEM_DEFAULT_BREADCRUMB_XPATH)
+
+
+def parse_date(date_text):
+    return datetime.datetime.strptime(date_text, "%Y年%m月%d日")
+
+
+def parse_datetime(date_text):
+    return datetime.datetime.strptime(date_text, "%Y年%m月%d日 %H:%M")
+
+
+def parse_price(price_text):
+    return int(re.match(r".*?(\d{1,3}(?:,\d{3})*)", price_text).group(1).replace(",", ""))
+
+
+def gen_item_id_from_url(url):
+    m = re.match(store_rakuten.const.ITEM_URL_PATTERN, url)
+
+    return "{store_id}/{item_id}".format(store_id=m.group(1), item_id=m.group(2))
+
+
+def parse_html(html, url=None):
+    tree = lxml.html.fromstring(html, base_url=url)
+
+    if url is not None:
+        tree.make_links_absolute(url)
+
+    return tree
+
+
+def parse_file(file_path):
+    with open(file_path, "r", encoding="utf-8") as f:
+        return parse_html(f.read())
+
+
+def get_text(elem):
+    # NOTE: Selenium の .text に合わせて，連続する空白を 1 つにまとめる
+    return " ".join(elem.text_content().split())
+
+
+def find_text(tree, xpath):
+    elem_list = xpath(tree)
+
+    if len(elem_list) == 0:
+        return None
+
+    return get_text(elem_list[0])
+
+
+def find_attr(tree, xpath, name):
+    elem_list = xpath(tree)
+
+    if len(elem_list) == 0:
+        return None
+
+    return elem_list[0].get(name)
+
+
+def is_login_page(tree):
+    return len(XPATH_LOGIN_BOX(tree)) != 0
+
+
+def parse_year_list(tree):
+    return list(sorted(map(lambda elem: int(elem.get("value")), XPATH_YEAR_OPTION(tree))))
+
+
+def parse_order_count(tree):
+    if len(XPATH_NO_ITEM(tree)) != 0:
+        return 0
+
+    return int(find_text(tree, XPATH_TOTAL_ITEM))
+
+
+def parse_order_list(tree):
+    order_list = []
+    for order_elem in XPATH_ORDER_LIST(tree):
+        no = find_text(order_elem, XPATH_ORDER_LIST_NO)
+        if no is None:
+            continue
+
+        order_list.append(
+            {
+                "date": parse_date(find_text(order_elem, XPATH_ORDER_LIST_DATE)),
+                "no": no,
+                "url": find_attr(order_elem, XPATH_ORDER_LIST_URL, "href"),
+                "seller": find_text(order_elem, XPATH_ORDER_LIST_SELLER),
+            }
+        )
+
+    return order_list
+
+
+def parse_order_error(tree):
+    return find_text(tree, XPATH_ORDER_ERROR)
+
+
+def parse_order_book(tree, order_info):
+    item_base = {
+        "date": parse_datetime(find_text(tree, XPATH_ORDER_BOOK_DATE).rsplit(" ", 1)[0]),
+        "no": find_text(tree, XPATH_ORDER_BOOK_NO),
+        "seller": order_info["seller"],
+    }
+
+    item_list = []
+    for item_elem in XPATH_ORDER_BOOK_ITEM(tree):
+        link = XPATH_ORDER_BOOK_ITEM_LINK(item_elem)[0]
+        url = link.get("href")
+
+        item_list.append(
+            {
+                "name": get_text(link),
+                "price": parse_price(find_text(item_elem, XPATH_ORDER_BOOK_ITEM_PRICE)),
+                "count": int(find_text(item_elem, XPATH_ORDER_BOOK_ITEM_COUNT)),
+                "url": url,
+                "id": gen_item_id_from_url(url),
+                "thumb_url": find_attr(item_elem, XPATH_ORDER_BOOK_ITEM_THUMB, "src"),
+            }
+            | item_base
+        )
+
+    return item_list
+
+
+def parse_order_default(tree, order_info):
+    item_base = {
+        "date": parse_date(find_text(tree, XPATH_ORDER_DEFAULT_DATE)),
+        "no": find_text(tree, XPATH_ORDER_DEFAULT_NO),
+        "seller": order_info["seller"],
+    }
+
+    item_list = []
+    for item_elem in XPATH_ORDER_DEFAULT_ITEM(tree):
+        link = XPATH_ORDER_DEFAULT_ITEM_LINK(item_elem)[0]
+        url = link.get("href")
+
+        item_list.append(
+            {
+                "name": get_text(link),
+                "price": parse_price(find_text(item_elem, XPATH_ORDER_DEFAULT_ITEM_PRICE)),
+                "count": int(find_text(item_elem, XPATH_ORDER_DEFAULT_ITEM_COUNT)),
+                "url": url,
+                "include_tax": find_text(item_elem, XPATH_ORDER_DEFAULT_ITEM_TAX) == "込",
+                "id": gen_item_id_from_url(url),
+                "thumb_url": find_attr(item_elem, XPATH_ORDER_DEFAULT_ITEM_THUMB, "src"),
+            }
+            | item_base
+        )
+
+    return item_list
+
+
+def parse_order(tree, order_info):
+    if order_info["seller"] == SELLER_BOOK:
+        return parse_order_book(tree, order_info)
+    else:
+        return parse_order_default(tree, order_info)
+
+
+def parse_item_category(tree, seller):
+    if seller == SELLER_BOOK:
+        breadcrumb_list = XPATH_ITEM_BOOK_BREADCRUMB(tree)
+    else:
+        breadcrumb_list = XPATH_ITEM_DEFAULT_BREADCRUMB(tree)
+
+    category = list(map(get_text, breadcrumb_list))
+
+    # NOTE: 先頭は「楽天市場トップ」等なので除く
+    if len(category) >= 1:
+        category.pop(0)
+
+    return category
+
+
+def detect_page_type(tree):
+    if is_login_page(tree):
+        return "login"
+    elif len(XPATH_ORDER_LIST(tree)) != 0 or len(XPATH_NO_ITEM(tree)) != 0:
+        return "order_list"
+    elif len(XPATH_ORDER_BOOK_DATE(tree)) != 0:
+        return "order_book"
+    elif len(XPATH_ORDER_DEFAULT_DATE(tree)) != 0:
+        return "order_default"
+    elif len(XPATH_ORDER_ERROR(tree)) != 0:
+        return "order_error"
+    elif len(XPATH_ITEM_BOOK_BREADCRUMB(tree)) != 0:
+        return "item_book"
+    elif len(XPATH_ITEM_DEFAULT_BREADCRUMB(tree)) != 0:
+        return "item_default"
+    else:
+        return None
+
+
+def parse_page(tree):
+    page_type = detect_page_type(tree)
+
+    if page_type == "order_list":
+        return {
+            "type": page_type,
+            "year_list": parse_year_list(tree),
+            "count": parse_order_count(tree),
+            "order_list": parse_order_list(tree),
+        }
+    elif page_type == "order_book":
+        return {"type": page_type, "item_list": parse_order_book(tree, {"seller": SELLER_BOOK})}
+    elif page_type == "order_default":
+        # NOTE: 注文詳細ページ単体からはストア名が分からない
+        return {"type": page_type, "item_list": parse_order_default(tree, {"seller": None})}
+    elif page_type == "order_error":
+        return {"type": page_type, "error": parse_order_error(tree)}
+    elif page_type == "item_book":
+        return {"type": page_type, "category": parse_item_category(tree, SELLER_BOOK)}
+    elif page_type == "item_default":
+        return {"type": page_type, "category": parse_item_category(tree, None)}
+    else:
+        return {"type": page_type}
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+    import logging
+    import pprint
+    import time
+
+    import local_lib.logger
+
+    args = docopt(__doc__)
+
+    local_lib.logger.init("test", level=logging.INFO)
+
+    count = int(args["-n"])
+
+    for file_path in args["FILE"]:
+        with open(file_path, "r", encoding="utf-8") as f:
+            html = f.read()
+
+        start = time.perf_counter()
+        for _ in range(count):
+            page = parse_page(parse_html(html))
+        elapsed = (time.perf_counter() - start) / count
+
+        logging.info("{file_path}: {elapsed:.3f} ms/page".format(file_path=file_path, elapsed=elapsed * 1000))
+        logging.info(pprint.pformat(page))
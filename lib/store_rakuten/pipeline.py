@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# NOTE: 注文履歴を，以下の段階に分けて並行に処理する．
+#
+#   注文一覧ページ → 注文詳細ページ → 商品ページ (カテゴリ) → サムネイル
+#
+# 段階の間は上限付きのキューで繋ぎ，後段が詰まれば前段が待つようにする．
+# 結果の記録は，注文一覧に現れた順に行う．ページの全注文を記録し終えた時点で
+# そのページを巡回済みにするので，中断した場合も従来通り途中から再開できる．
+#
+# 差分収集 (crawl_incremental) では，全ての年を新しい順に辿り，収集済みの注文に
+# 行き当たった時点で一覧の取得を打ち切る．
+#
+# 取得に失敗した注文は間隔を空けて再試行し，それでも失敗する場合は再試行リストに
+# 移して巡回を続ける．商品ページの取得に失敗した場合も，その商品を含む注文を移す．
+# 再試行リストの注文は，次回の実行時 (crawl_retry) に取得し直す．
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import time
+import traceback
+
+import store_rakuten.crawler
+import store_rakuten.handle
+import store_rakuten.thumbnail
+
+QUEUE_SIZE = 50
+
+RETRY_WAIT_SEC = 5
+# NOTE: これだけ続けて注文や商品の取得に失敗した場合は，一時的な問題ではないとみなして中断する
+QUARANTINE_STREAK_MAX = 5
+CHECKPOINT_INTERVAL_SEC = 30
+
+
+def get_queue_size(handle):
+    return handle["config"].get("crawl", {}).get("queue_size", QUEUE_SIZE)
+
+
+def run_on_main(ctx, func, *args):
+    handle = ctx["handle"]
+
+    if store_rakuten.handle.is_http_enabled(handle):
+        return asyncio.to_thread(func, handle, *args)
+
+    # NOTE: メインの driver は，専用のスレッド 1 つからのみ操作する
+    return asyncio.get_running_loop().run_in_executor(
+        ctx["browser_executor"], functools.partial(func, handle, *args)
+    )
+
+
+def run_on_worker(ctx, func, *args):
+    handle = ctx["handle"]
+
+    if store_rakuten.handle.is_http_enabled(handle) or (store_rakuten.handle.get_worker_count(handle) <= 1):
+        return run_on_main(ctx, func, *args)
+
+    return asyncio.wrap_future(store_rakuten.handle.run_on_selenium_worker(handle, func, *args))
+
+
+def update_progress_bar(ctx, year):
+    handle = ctx["handle"]
+
+    year_label = store_rakuten.crawler.gen_status_label_by_year(year)
+    if year_label in handle["progress_bar"]:
+        store_rakuten.handle.get_progress_bar(handle, year_label).update()
+
+    store_rakuten.handle.get_progress_bar(handle, ctx["bar_label"]).update()
+    store_rakuten.handle.update_rate_status(handle)
+
+
+def checkpoint(ctx):
+    store_rakuten.handle.store_order_info(ctx["handle"])
+
+    ctx["checkpoint_time"] = time.perf_counter()
+    ctx["is_dirty"] = False
+
+
+def flush(ctx):
+    handle = ctx["handle"]
+
+    slot_list = ctx["slot_list"]
+    while (ctx["flush_index"] < len(slot_list)) and slot_list[ctx["flush_index"]]["done"]:
+        slot = slot_list[ctx["flush_index"]]
+        ctx["flush_index"] += 1
+
+        if slot["order_info"] is None:
+            # NOTE: ページの区切り
+            store_rakuten.handle.set_page_checked(handle, slot["year"], slot["page"], slot["order_no_list"])
+            checkpoint(ctx)
+            continue
+
+        if slot["is_cached"]:
+            logging.info(
+                "Done order: {date} - {no} [cached]".format(
+                    date=slot["order_info"]["date"].strftime("%Y-%m-%d"), no=slot["order_info"]["no"]
+                )
+            )
+        elif slot["is_quarantined"]:
+            logging.warning(
+                "Give up order: {date} - {no}, retry next time".format(
+                    date=slot["order_info"]["date"].strftime("%Y-%m-%d"), no=slot["order_info"]["no"]
+                )
+            )
+            store_rakuten.handle.add_retry_order(handle, slot["order_info"])
+            ctx["is_dirty"] = True
+        else:
+            store_rakuten.crawler.record_order_item_list(handle, slot["item_list"])
+            store_rakuten.handle.remove_retry_order(handle, slot["order_info"]["no"])
+            ctx["is_dirty"] = True
+
+        update_progress_bar(ctx, slot["year"])
+
+    # NOTE: ページの途中で中断しても，記録済みの注文を取得し直さずに済むようにする
+    if ctx["is_dirty"] and (time.perf_counter() - ctx["checkpoint_time"] > CHECKPOINT_INTERVAL_SEC):
+        checkpoint(ctx)
+
+
+def complete_item(ctx, slot):
+    slot["remain"] -= 1
+
+    if slot["remain"] == 0:
+        slot["done"] = True
+        flush(ctx)
+
+
+async def push_order_list(ctx, year, order_list):
+    handle = ctx["handle"]
+
+    for order_info in order_list:
+        is_cached = store_rakuten.handle.get_order_stat(handle, order_info["no"])
+        slot = {
+            "year": year,
+            "order_info": order_info,
+            "is_cached": is_cached,
+            "is_quarantined": False,
+            "item_list": [],
+            "remain": 0,
+            "done": is_cached,
+        }
+        ctx["slot_list"].append(slot)
+
+        if not is_cached:
+            await ctx["order_queue"].put(slot)
+
+
+async def order_list_stage(ctx, year, start_page):
+    handle = ctx["handle"]
+
+    page = start_page
+    while True:
+        if store_rakuten.handle.get_page_checked(handle, year, page):
+            is_last = store_rakuten.crawler.skip_order_item_list_by_year_page(handle, year, page)
+        else:
+            order_list, is_last = await run_on_main(
+                ctx, store_rakuten.crawler.fetch_order_list_by_year_page, year, page
+            )
+
+            await push_order_list(ctx, year, order_list)
+
+            ctx["slot_list"].append(
+                {
+                    "year": year,
+                    "order_info": None,
+                    "page": page,
+                    "order_no_list": [order_info["no"] for order_info in order_list],
+                    "done": True,
+                }
+            )
+            flush(ctx)
+
+        if is_last:
+            break
+
+        page += 1
+
+
+async def incremental_order_list_stage(ctx):
+    handle = ctx["handle"]
+
+    # NOTE: 新しい年・ページから順に辿り，収集済みの注文が現れた時点で打ち切る．
+    # ページ内の注文の位置は新しい注文が増える度にずれるので，ページの巡回状況は記録しない．
+    for year in reversed(store_rakuten.handle.get_year_list(handle)):
+        page = 1
+        while True:
+            order_list, is_known_found, is_last = await run_on_main(
+                ctx, store_rakuten.crawler.fetch_new_order_list_by_year_page, year, page
+            )
+
+            store_rakuten.handle.add_order_count(handle, year, len(order_list))
+            ctx["year_set"].add(year)
+
+            await push_order_list(ctx, year, order_list)
+
+            if is_known_found:
+                return
+            if is_last:
+                break
+
+            page += 1
+
+
+async def retry_order_list_stage(ctx):
+    for order_info in store_rakuten.handle.get_retry_order_list(ctx["handle"]):
+        # NOTE: 再試行リストの注文は収集済みとして扱われていないので，そのまま投入される
+        await push_order_list(ctx, order_info["date"].year, [order_info])
+
+
+async def run_with_retry(ctx, label, func, *args):
+    for i in range(store_rakuten.crawler.FETCH_RETRY_COUNT):
+        try:
+            return await run_on_worker(ctx, func, *args)
+        except Exception:
+            if i == store_rakuten.crawler.FETCH_RETRY_COUNT - 1:
+                raise
+
+            wait_sec = RETRY_WAIT_SEC * (2**i)
+
+            logging.warning(traceback.format_exc())
+            logging.warning(
+                "Failed to fetch {label}, retry after {wait_sec} sec ({count}/{total})".format(
+                    label=label, wait_sec=wait_sec, count=i + 1, total=store_rakuten.crawler.FETCH_RETRY_COUNT
+                )
+            )
+
+            await asyncio.sleep(wait_sec)
+
+
+async def order_stage(ctx):
+    while True:
+        slot = await ctx["order_queue"].get()
+        try:
+            try:
+                item_list = await run_with_retry(
+                    ctx,
+                    "order {no}".format(no=slot["order_info"]["no"]),
+                    store_rakuten.crawler.fetch_order_item_list_by_order_info,
+                    slot["order_info"],
+                )
+                ctx["quarantine_streak"] = 0
+            except Exception:
+                logging.warning(traceback.format_exc())
+
+                ctx["quarantine_streak"] += 1
+                if ctx["quarantine_streak"] >= QUARANTINE_STREAK_MAX:
+                    raise
+
+                slot["is_quarantined"] = True
+                item_list = []
+
+            slot["item_list"] = item_list
+            slot["remain"] = len(item_list)
+
+            if len(item_list) == 0:
+                slot["done"] = True
+                flush(ctx)
+
+            for item in item_list:
+                await ctx["item_queue"].put((slot, item))
+        finally:
+            ctx["order_queue"].task_done()
+
+
+async def item_stage(ctx):
+    while True:
+        slot, item = await ctx["item_queue"].get()
+        try:
+            try:
+                await run_with_retry(
+                    ctx, "item {id}".format(id=item["id"]), store_rakuten.crawler.fetch_item_detail, item
+                )
+                ctx["quarantine_streak"] = 0
+            except Exception:
+                logging.warning(traceback.format_exc())
+
+                ctx["quarantine_streak"] += 1
+                if ctx["quarantine_streak"] >= QUARANTINE_STREAK_MAX:
+                    raise
+
+                # NOTE: 商品の一部が欠けたまま記録しないよう，注文ごと再試行リストに移す
+                slot["is_quarantined"] = True
+                complete_item(ctx, slot)
+                continue
+
+            await ctx["thumb_queue"].put((slot, item))
+        finally:
+            ctx["item_queue"].task_done()
+
+
+async def thumb_stage(ctx):
+    while True:
+        slot, item = await ctx["thumb_queue"].get()
+        try:
+            thumb_url = item.pop("thumb_url")
+
+            await asyncio.to_thread(store_rakuten.thumbnail.save, ctx["handle"], item, thumb_url)
+        except Exception:
+            # NOTE: サムネイルが無くても Excel は作れるので，エラーは記録するだけにする
+            logging.warning(traceback.format_exc())
+        finally:
+            complete_item(ctx, slot)
+            ctx["thumb_queue"].task_done()
+
+
+async def wait_task(task, worker_list):
+    # NOTE: 各段階のタスクは通常終了しないので，終了した場合は例外が発生している
+    while not task.done():
+        done, pending = await asyncio.wait([task, *worker_list], return_when=asyncio.FIRST_COMPLETED)
+
+        for worker in done:
+            if worker is not task:
+                worker.result()
+
+    task.result()
+
+
+async def run(handle, list_stage, bar_label=None):
+    queue_size = get_queue_size(handle)
+
+    ctx = {
+        "handle": handle,
+        # NOTE: store_rakuten.crawler とは相互に import しているので，定義時には参照できない
+        "bar_label": store_rakuten.crawler.STATUS_ORDER_ITEM_ALL if bar_label is None else bar_label,
+        "order_queue": asyncio.Queue(queue_size),
+        "item_queue": asyncio.Queue(queue_size),
+        "thumb_queue": asyncio.Queue(queue_size),
+        "slot_list": [],
+        "flush_index": 0,
+        "year_set": set(),
+        "quarantine_streak": 0,
+        "checkpoint_time": time.perf_counter(),
+        "is_dirty": False,
+        "browser_executor": concurrent.futures.ThreadPoolExecutor(max_workers=1),
+    }
+
+    worker_list = (
+        [asyncio.create_task(order_stage(ctx)) for _ in range(store_rakuten.handle.get_worker_count(handle))]
+        + [
+            asyncio.create_task(item_stage(ctx))
+            for _ in range(store_rakuten.handle.get_item_worker_count(handle))
+        ]
+        + [
+            asyncio.create_task(thumb_stage(ctx))
+            for _ in range(store_rakuten.handle.get_thumb_worker_count(handle))
+        ]
+    )
+
+    task_list = list(worker_list)
+    try:
+        task = asyncio.create_task(list_stage(ctx))
+        task_list.append(task)
+        await wait_task(task, worker_list)
+
+        for queue in [ctx["order_queue"], ctx["item_queue"], ctx["thumb_queue"]]:
+            task = asyncio.create_task(queue.join())
+            task_list.append(task)
+            await wait_task(task, worker_list)
+    finally:
+        for task in task_list:
+            task.cancel()
+        await asyncio.gather(*task_list, return_exceptions=True)
+
+        ctx["browser_executor"].shutdown()
+
+        if ctx["is_dirty"]:
+            checkpoint(ctx)
+
+    return ctx
+
+
+async def crawl_year(handle, year, start_page=1):
+    return await run(handle, lambda ctx: order_list_stage(ctx, year, start_page))
+
+
+async def crawl_incremental(handle):
+    ctx = await run(handle, incremental_order_list_stage)
+
+    return (sorted(ctx["year_set"]), len(ctx["slot_list"]))
+
+
+async def crawl_retry(handle):
+    await run(handle, retry_order_list_stage, store_rakuten.crawler.STATUS_ORDER_RETRY)
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import tempfile
+
+import local_lib.http_util
+import store_rakuten.handle
+
+
+def download(handle, thumb_url, thumb_path):
+    res = local_lib.http_util.get(store_rakuten.handle.get_http_session(handle), thumb_url)
+
+    # NOTE: 書き込み途中のファイルを取得済みと判断しないよう，一時ファイルに書いてから置き換える
+    f = tempfile.NamedTemporaryFile(dir=str(thumb_path.parent), delete=False)
+    f.write(res.content)
+    f.close()
+
+    os.replace(f.name, thumb_path)
+
+
+def save(handle, item, thumb_url):
+    thumb_path = store_rakuten.handle.get_thumb_path(handle, item)
+
+    if thumb_path.exists():
+        logging.debug("Thumbnail of {id} [cached]".format(id=item["id"]))
+        return
+
+    if thumb_url is None:
+        logging.warning("Thumbnail of {id} is not found".format(id=item["id"]))
+        return
+
+    with store_rakuten.handle.trace(handle, "thumbnail", "item", id=item["id"]):
+        download(handle, thumb_url, thumb_path)